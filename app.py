@@ -1,10 +1,10 @@
 import os
 from dotenv import load_dotenv
 
-from flask import Flask, redirect, url_for, jsonify, render_template
-from models.db_model import init_db, migrate_db
+from flask import Flask, Response, redirect, url_for, jsonify, render_template
+from models.db_model import init_db, migrate_db, get_db_pool_status
 from views import model_views  # views.pyからmodel_viewsをインポート
-from simulation_views import simu_views
+from simulation_views import simu_views, job_model
 
 # dotenv
 load_dotenv()
@@ -40,5 +40,20 @@ def sitemap():
             links.append(url)
     return render_template('sitemap.html', links=links)
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus形式のメトリクス（キュー・ジョブ・結果はRedisから、DBプールはこのプロセスの値）"""
+    writer = job_model.get_metrics_writer()
+
+    pool = get_db_pool_status()
+    if pool:
+        labels = {"pid": os.getpid()}
+        writer.add("spice_db_pool_connections", "gauge", "Database pool connections of this web process.", [
+            ("", {**labels, "state": state}, pool[state]) for state in ("checked_out", "checked_in", "overflow")
+        ])
+        writer.add("spice_db_pool_size", "gauge", "Configured database pool size.", [("", labels, pool["size"])])
+
+    return Response(writer.render(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == '__main__':
     app.run()
@@ -25,6 +25,18 @@ def get_db_connection():
         )
     return _engine
 
+def get_db_pool_status():
+    """このプロセスのコネクションプールの状態を取得（エンジン未作成の場合はNone）"""
+    if _engine is None:
+        return None
+    pool = _engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+    }
+
 # データベースに再接続してテーブルを作成
 def init_db():
     # データベースに再接続してテーブルを作成
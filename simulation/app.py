@@ -1,12 +1,47 @@
 import os
-from flask import Flask
+import socket
+import json
+from flask import Flask, Response
+from redis import Redis
+
+from metrics import MetricsWriter, collect_redis_metrics
 
 app = Flask(__name__)
 
+# 環境変数からRedisの接続情報を取得（redis_worker.pyと同じ設定）
+redis = Redis(
+    host=os.environ.get("REDISHOST", "localhost"),
+    port=int(os.environ.get("REDISPORT", 6379)),
+    db=int(os.environ.get("REDISDB", 0)),
+)
+WORKER_ID = os.environ.get("WORKER_ID", socket.gethostname())
+
 @app.route('/')
 def hello_world():
     return 'Hello from your friendly neighborhood Flask app!'
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus形式のメトリクス（キューの長さでシミュレーションコンテナをオートスケールするため）"""
+    writer = MetricsWriter()
+    collect_redis_metrics(redis, writer)
+
+    # このノードのスロットの状態
+    slot_counts = {}
+    for value in redis.hvals(f"worker:{WORKER_ID}:slots"):
+        status = json.loads(value).get("status", "unknown")
+        slot_counts[status] = slot_counts.get(status, 0) + 1
+    writer.add("spice_worker_slots", "gauge", "Simulation slots of this worker by status.", [
+        ("", {"worker": WORKER_ID, "status": status}, count) for status, count in sorted(slot_counts.items())
+    ])
+
+    restarts = redis.hget("metrics:wine_restarts", WORKER_ID)
+    writer.add("spice_wine_restarts_total", "counter", "Restarts of the persistent wineserver after a failed health check.", [
+        ("", {"worker": WORKER_ID}, int(restarts or 0)),
+    ])
+
+    return Response(writer.render(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == '__main__':
     # PORT環境変数を取得し、デフォルト値は8080
     port = int(os.environ.get('PORT', 8080))
@@ -1,15 +1,47 @@
+import io
 import os  # ファイルパスやディレクトリ操作
-import re
+import copy
 import json
+import time
 import itertools
+import threading
 
 import numpy as np  # 数値計算
-import matplotlib.pyplot as plt  # プロットの作成
+from matplotlib.figure import Figure  # プロットの作成（pyplotのグローバルな状態は使わない）
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-from PyLTSpice import SpiceEditor, RawRead  # PyLTSpiceライブラリの必要な機能
+from PyLTSpice import SpiceEditor  # PyLTSpiceライブラリの必要な機能
 from bokeh.plotting import figure
 from bokeh.embed import json_item
 
+try:
+    from simulation.raw_reader import LazyRawRead, TracePayload, SweepResult, decode_log, parse_log_values
+except ImportError:  # simulationディレクトリ内から直接実行する場合
+    from raw_reader import LazyRawRead, TracePayload, SweepResult, decode_log, parse_log_values
+
+
+# 解析済みのテンプレート（プロセスごとに1回だけ解析し、使うときはコピーする）
+_template_cache = {}
+
+# Matplotlibの図（スレッドごとに1つを作って使い回す。pyplotを使わないので複数スレッドから同時に描画できる）
+_figure_local = threading.local()
+
+# Bokehのプロットに送る点数の上限（曲線ごとと、全曲線の合計）
+PLOT_MAX_POINTS = int(os.environ.get("PLOT_MAX_POINTS", 2000))
+PLOT_MAX_TOTAL_POINTS = int(os.environ.get("PLOT_MAX_TOTAL_POINTS", 20000))
+
+# 実行時間の見積もり（LTspiceの起動などの固定分と、解析点1点あたりの時間）
+COST_OVERHEAD_SECONDS = 0.5
+COST_SECONDS_PER_POINT = 5e-5
+
+def load_template(template_path):
+    """テンプレートのネットリストを解析済みのキャッシュからコピーして返す"""
+    template = _template_cache.get(template_path)
+    if template is None:
+        template = _template_cache[template_path] = SpiceEditor(template_path)
+    return copy.deepcopy(template)
+
 
 color_map = [
     '#1f77b4',  # 青
@@ -24,10 +56,56 @@ color_map = [
     '#17becf'   # シアン
 ]
 
+def get_figure():
+    """このスレッド専用の図を消去して返す（Aggのキャンバスごと使い回す）"""
+    fig = getattr(_figure_local, "figure", None)
+    if fig is None:
+        fig = Figure(figsize=(8, 6))
+        FigureCanvasAgg(fig)
+        _figure_local.figure = fig
+    fig.clear()
+    return fig
+
+
+def render_png(fig):
+    """図をPNGとしてメモリ上に描画し、そのバイト列を返す"""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def decimate_curve(x, y, max_points=None):
+    """
+    曲線をmin/maxの間引きでmax_points点以下にする（形を保ったままブラウザに送る点数を抑える）。
+    点の並びを等分した区間ごとにyの最小と最大の点を元の順序で残し、両端の点は必ず残す。
+    """
+    max_points = max_points or PLOT_MAX_POINTS
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(y)
+    if n <= max_points or max_points < 4:
+        return x, y
+
+    # 両端の2点を除いた分を区間に割り当てる（区間ごとに最小と最大の2点）
+    buckets = (max_points - 2) // 2
+    size = -(-n // buckets)
+    padded = np.pad(y, (0, buckets * size - n), mode='edge').reshape(buckets, size)
+    offsets = np.arange(buckets) * size
+    indices = np.concatenate(([0], offsets + padded.argmin(axis=1), offsets + padded.argmax(axis=1), [n - 1]))
+    indices = np.unique(np.minimum(indices, n - 1))  # 並べ替えと重複の除去
+    return x[indices], y[indices]
+
+
+def count_sweep_points(span, step):
+    """0からspanまでをstep刻みで掃引したときの点数"""
+    return int(abs(span) / abs(step) + 1e-9) + 1
+
+
 class JFET_SimulationBase:
 
     VALID_TYPES = ["NJF", "PJF"]
     _SIMULATION_NAME = 'jfet_dc'  # default
+    REQUIRED_TRACES = None  # ワーカーに抽出させる波形（Noneの場合は.rawをそのまま受け取る）
 
     def __init__(self, device_name, device_type, spice_string):
         self.device_name = device_name
@@ -42,6 +120,9 @@ class JFET_SimulationBase:
         self.net = None
         self.raw_data = None
         self.log_data = None
+        self.op_values = None  # ワーカーが.logから取り出した動作点の値（.tracesを読み込んだ場合）
+        self.job_id = None  # シミュレーションを実行したジョブのID
+        self.timings = {}  # 処理段階ごとの所要時間（秒）
 
         self.config = self._CONFIG.copy()  # インスタンスごとに設定を分離
 
@@ -92,72 +173,152 @@ class JFET_SimulationBase:
 
     def modify_netlist(self):
         """JFETのモデルを交換する(共通の動作)"""
-        self.net = SpiceEditor(self.template_path)
+        self.net = load_template(self.template_path)
         self.net.set_component_value('J1', self.device_name)
         self.net.add_instructions(self.spice_string)
 
-    def build(self):
+    def get_netlist_filename(self):
+        return f"{self.simulation_name}_{self.device_name}.net"
+
+    def get_sweep_points(self):
+        """設定から解析点の数を求める（掃引のないクラスは1点）"""
+        return 1
+
+    def estimate_cost(self):
+        """ジョブを投入する前に、設定から解析点の数と実行時間（秒）を見積もる"""
+        points = self.get_sweep_points()
+        return {"points": points, "seconds": COST_OVERHEAD_SECONDS + points * COST_SECONDS_PER_POINT}
+
+    def render(self):
+        """ネットリストをファイルに保存せずに作成し、(ファイル名, 内容のbytes) を返す"""
+        start_time = time.perf_counter()
         self.modify_netlist()
-        run_filename = f"{self.simulation_name}_{self.device_name}.net"
-        netlist_path = os.path.join(self.output_folder, run_filename)
-        self.net.save_netlist(netlist_path)
+        buffer = io.StringIO()
+        self.net.save_netlist(buffer)
+        netlist_data = buffer.getvalue().encode(getattr(self.net, 'encoding', None) or 'utf-8')
+        self.timings["build"] = time.perf_counter() - start_time
+
+        return self.get_netlist_filename(), netlist_data
+
+    def build(self):
+        """ネットリストを作成してoutput_folderに保存し、そのパスを返す（ローカルで実行する場合）"""
+        filename, netlist_data = self.render()
+        netlist_path = os.path.join(self.output_folder, filename)
+        with open(netlist_path, 'wb') as f:
+            f.write(netlist_data)
 
         return netlist_path
 
     def load_results(self, raw_file, log_file):
         """外部で実行されたシミュレーション結果を読み込む"""
-        self.raw_data = RawRead(raw_file)
+        start_time = time.perf_counter()
+        self.raw_data = LazyRawRead(raw_file)  # 波形は参照されたときに初めてデコードされる
         with open(log_file, 'r') as log:
             self.log_data = log.read()
+        self.timings["load"] = time.perf_counter() - start_time
+
+    def load_results_from_memory(self, raw_data, log_data):
+        """メモリ上のシミュレーション結果（.rawと.logのバイナリ）を読み込む"""
+        start_time = time.perf_counter()
+        # .rawはファイルを経由せずバッファを直接参照する
+        self.raw_data = LazyRawRead(raw_data)
+        self.log_data = decode_log(log_data)
+        self.timings["load"] = time.perf_counter() - start_time
+
+    def load_trace_payload(self, payload, log_data):
+        """ワーカーが抽出した波形のペイロード(.traces)と.logを読み込む"""
+        start_time = time.perf_counter()
+        self.raw_data = TracePayload(payload)
+        self.op_values = self.raw_data.op_values
+        self.log_data = decode_log(log_data)
+        self.timings["load"] = time.perf_counter() - start_time
 
     def extract_data(self):
         """シミュレーション結果から必要なデータを抽出"""
         raise NotImplementedError("このメソッドはサブクラスで実装してください")
 
-    def save_image(self, plt, filename=None):
+    def save_image(self, png_data, filename=None):
+        """plot()で作成したPNGをimagesフォルダに保存し、そのパスを返す（ローカルで実行する場合）"""
         if not filename:
             filename = f"jfet_{self.simulation_name}_{self.device_name}.png"
         image_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
         os.makedirs(image_dir, exist_ok=True)
         image_path = os.path.join(image_dir, filename)
-        plt.savefig(image_path)
-        plt.clf()
-        plt.close()
+        with open(image_path, 'wb') as f:
+            f.write(png_data)
         return image_path
 
     def dump_json(self, p):
         return json.dumps(json_item(p)) 
 
-    def plot_data(self, *args):
-        """データをプロットするメソッド（サブクラスで実装）"""
+    def plot_data(self, ax, *args):
+        """データをaxにプロットするメソッド（サブクラスで実装）"""
         raise NotImplementedError("このメソッドはサブクラスで実装してください")
 
     def plot(self, json=False, measurement_data=None):
-        """抽出したデータをプロットし、画像ファイルのパスを返却する"""
-        
+        """抽出したデータをプロットし、PNGのバイト列（json=Trueの場合はBokehのJSON）を返す"""
+        start_time = time.perf_counter()
+        try:
+            return self._plot(json, measurement_data)
+        finally:
+            self.timings["plot"] = time.perf_counter() - start_time
+
+    def plot_arrays(self, measurement_data=None):
+        """
+        Bokehの図を、データを空にしたjson_itemと、データソースごとのfloat32配列に分けて返す。
+        クライアントは図を埋め込んだ後、名前 ("source-<番号>") で探したデータソースに配列を設定する。
+
+        Returns:
+            tuple: (json_itemのdict, {データソース名: {列名: float32の配列}})
+        """
+        start_time = time.perf_counter()
+        try:
+            p = self.build_bokeh(measurement_data)
+            arrays = {}
+            for i, renderer in enumerate(p.renderers):
+                source = renderer.data_source
+                source.name = f"source-{i}"
+                arrays[source.name] = {
+                    column: np.ascontiguousarray(values, dtype='<f4') for column, values in source.data.items()
+                }
+                source.data = {column: [] for column in source.data}
+            return json_item(p), arrays
+        finally:
+            self.timings["plot"] = time.perf_counter() - start_time
+
+    def build_bokeh(self, measurement_data=None):
+        """抽出したデータからBokehの図を作成（測定データがあれば追加）"""
         # シミュレーション結果が読み込まれていない場合、エラーを投げる
         if not self.raw_data:
             raise ValueError("シミュレーション結果が読み込まれていません")
 
-        # データの抽出
-        data = self.extract_data()
+        p = self.plot_bokeh(*self.extract_data())  # Bokehプロット作成
+        if measurement_data:
+            # 測定データをBokehプロットに追加
+            p = self.add_measurement_data(p, measurement_data["x"], measurement_data["y"], plot_type="bokeh")
+        return p
 
+    def _plot(self, json, measurement_data):
         # JSON形式でプロットを返す場合
         if json:
-            p = self.plot_bokeh(*data)  # Bokehプロット作成
-            if measurement_data:
-                # 測定データをBokehプロットに追加
-                p = self.add_measurement_data(p, measurement_data["x"], measurement_data["y"], plot_type="bokeh")
-            return self.dump_json(p) # プロットをJSON形式で返す
-
-        # 画像ファイルを保存する場合（Matplotlib）
-        plt_obj = self.plot_data(*data)  # Matplotlibプロット作成
+            return self.dump_json(self.build_bokeh(measurement_data))  # プロットをJSON形式で返す
+
+        # シミュレーション結果が読み込まれていない場合、エラーを投げる
+        if not self.raw_data:
+            raise ValueError("シミュレーション結果が読み込まれていません")
+
+        # データの抽出
+        data = self.extract_data()
+
+        # 画像を作成する場合（Matplotlib）
+        fig = get_figure()
+        ax = self.plot_data(fig.add_subplot(), *data)  # Matplotlibプロット作成
         if measurement_data:
             # 測定データをMatplotlibプロットに追加
-            plt_obj = self.add_measurement_data(plt_obj, measurement_data["x"], measurement_data["y"], plot_type="matplotlib")
-        
-        # 画像ファイルとして保存して返す
-        return self.save_image(plt_obj)
+            ax = self.add_measurement_data(ax, measurement_data["x"], measurement_data["y"], plot_type="matplotlib")
+
+        # ファイルには保存せずメモリ上で描画して返す
+        return render_png(fig)
 
 
     def add_measurement_data(self, p, x, y, color="black", legend_label="Measured Data", plot_type="bokeh"):
@@ -165,7 +326,7 @@ class JFET_SimulationBase:
         if plot_type == "bokeh":
             p.scatter(x, y, size=8, color=color, legend_label=legend_label)
         elif plot_type == "matplotlib":
-            if isinstance(p, plt.Axes):  # Matplotlib のプロットオブジェクトを確認
+            if isinstance(p, Axes):  # Matplotlib のプロットオブジェクトを確認
                 p.scatter(x, y, s=8**2, c=color, label=legend_label)  # s は面積で指定
                 p.legend(title="Legend")
             else:
@@ -178,6 +339,7 @@ class JFET_SimulationBase:
 class JFET_Basic_Performance(JFET_SimulationBase):
 
     _SIMULATION_NAME = 'basic_performance'
+    REQUIRED_TRACES = []
 
     _CONFIG = {
         "VDS_ABSMAX": 10,
@@ -197,27 +359,16 @@ class JFET_Basic_Performance(JFET_SimulationBase):
         self.net.add_instructions('.op')
 
     def extract_data(self, include_units=True):
-        """.logファイルから基本性能指標に必要なデータを抽出"""
+        """動作点の値から基本性能指標に必要なデータを抽出"""
         performance_data = {}
 
-        # .logファイルの内容を読み込む
-        log_content = self.log_data
-
-        # 正規表現を使って必要な性能指標を抽出
-        patterns = {
-            'id': r"Id:\s+([\d\.\-e\+]+)",  # "Id: 1.34e-02" の形式
-            'vgs': r"Vgs:\s+([\d\.\-e\+]+)",  # "Vgs: 0.00e+00" の形式
-            'vds': r"Vds:\s+([\d\.\-e\+]+)",  # "Vds: 1.00e+01" の形式
-            'gm': r"Gm:\s+([\d\.\-e\+]+)",  # "Gm: 3.83e-02" の形式
-            'gds': r"Gds:\s+([\d\.\-e\+]+)",  # "Gds: 3.22e-05" の形式
-            'cgs': r"Cgs:\s+([\d\.\-e\+]+)",  # "Cgs: 1.34e-11" の形式
-            'cgd': r"Cgd:\s+([\d\.\-e\+]+)"  # "Cgd: 3.27e-12" の形式
-        }
+        # ワーカーが.logから取り出した値があればそれを使い、なければ.logを解析する
+        # （"Id:         1.34e-02" の形式、名前は小文字）
+        op_values = self.op_values if self.op_values is not None else parse_log_values(self.log_data)
 
-        for key, pattern in patterns.items():
-            match = re.search(pattern, log_content)
-            if match:
-                value = float(match.group(1))
+        for key in ('id', 'vgs', 'vds', 'gm', 'gds', 'cgs', 'cgd'):
+            if key in op_values:
+                value = op_values[key]
                 if key == 'id':
                     performance_data[key] = value * 1e3  # ミリアンペアに変換
                 elif key == 'vgs' or key == 'vds':
@@ -247,7 +398,7 @@ class JFET_Basic_Performance(JFET_SimulationBase):
 
     def get_basic_performance(self, include_units=False):
         """基本性能指標を返す"""
-        if not self.log_data:
+        if not self.log_data and self.op_values is None:
             raise ValueError("シミュレーション結果が読み込まれていません")
 
         data = self.extract_data(include_units=include_units)
@@ -257,6 +408,7 @@ class JFET_Basic_Performance(JFET_SimulationBase):
 class JFET_IV_Characteristic(JFET_SimulationBase):
 
     _SIMULATION_NAME = 'iv'
+    REQUIRED_TRACES = ['V(n001)', 'V(n002)', 'Id(J1)']
 
     _CONFIG = {
         "VGS_ABSMAX": 0.4,
@@ -273,6 +425,11 @@ class JFET_IV_Characteristic(JFET_SimulationBase):
         }
     }
 
+    def get_sweep_points(self):
+        """VgsとVdsの2重掃引"""
+        return (count_sweep_points(self.get_config("VGS_ABSMAX"), self.get_config("VGS_STEP"))
+                * count_sweep_points(self.get_config("VDS_ABSMAX"), self.get_config("VDS_STEP")))
+
     def modify_netlist(self):
         super().modify_netlist()
 
@@ -292,47 +449,43 @@ class JFET_IV_Characteristic(JFET_SimulationBase):
             )
 
     def extract_data(self):
-        """I-V特性に必要なデータを抽出"""
-        Vds = self.raw_data['V(n002)'].data  # Vds（ドレイン-ソース電圧）
-        Vgs = self.raw_data['V(n001)'].data  # Vgs（ゲート-ソース電圧）
-        Id = self.raw_data['Id(J1)'].data    # Id（ドレイン電流）
-        Id_mA = Id * 1e3  # ドレイン電流をmA単位に変換
-        return Vds, Vgs, Id_mA
-
-    def plot_data(self, Vds, Vgs, Id_mA):
+        """
+        I-V特性に必要なデータを (Vgsの点数, Vdsの点数) の2次元配列として抽出
+        （.dcの内側の掃引がV1(Vgs)なので、行ごとに1本のVgsの曲線になる）
+        """
+        sweep = SweepResult(self.raw_data, 'V(n001)', ['V(n002)', 'Id(J1)'])
+        Vgs = sweep.inner_values     # Vgs（ゲート-ソース電圧）の各値
+        Vds = sweep['V(n002)']       # Vds（ドレイン-ソース電圧）
+        Id_mA = sweep['Id(J1)'] * 1e3  # ドレイン電流をmA単位に変換
+
+        # Vgsの絶対値が大きい曲線から順に並べる
+        order = np.argsort(-np.abs(Vgs), kind='stable')
+        return Vds[order], Vgs[order], Id_mA[order]
+
+    def plot_data(self, ax, Vds, Vgs, Id_mA):
         """I-V特性をプロットする"""
-        plt.figure(figsize=(8, 6))
-
-        vgs_absmax = self.get_config("VGS_ABSMAX")
-        vgs_step = self.get_config("VGS_STEP")
-
-        if self.device_type == 'NJF':
-            vgs_list = np.linspace(-vgs_absmax, 0, round(vgs_absmax / vgs_step) + 1)  # -vgs_absmaxから0までの範囲
-        elif self.device_type == 'PJF':
-            vgs_list = np.linspace(vgs_absmax, 0, round(vgs_absmax / vgs_step) + 1)  # vgs_absmaxから0までの範囲
-
         color_cycle = itertools.cycle(color_map)
 
-        for vgs_value in vgs_list:
+        # 行ごとに1本のVgsの曲線
+        for vgs_value, vds_row, id_row in zip(Vgs, Vds, Id_mA):
             color = next(color_cycle)
-            mask = (Vgs >= vgs_value - vgs_step / 2) & (Vgs <= vgs_value + vgs_step / 2)
-            plt.plot(Vds[mask], Id_mA[mask], color=color, label=f'Vgs = {vgs_value:.2f}V')
+            ax.plot(vds_row, id_row, color=color, label=f'Vgs = {vgs_value:.2f}V')
 
-        plt.title("I-V Characteristic of JFET for Different Vgs")
-        plt.xlabel("Vds (Volts)")
-        plt.ylabel("Id (mA)")
+        ax.set_title("I-V Characteristic of JFET for Different Vgs")
+        ax.set_xlabel("Vds (Volts)")
+        ax.set_ylabel("Id (mA)")
 
         if self.device_type == 'PJF':
-            plt.gca().invert_xaxis()
-            plt.gca().invert_yaxis()
+            ax.invert_xaxis()
+            ax.invert_yaxis()
 
-        plt.xlim(0)
-        plt.ylim(0)
+        ax.set_xlim(0)
+        ax.set_ylim(0)
 
-        plt.grid(True)
-        plt.legend()
+        ax.grid(True)
+        ax.legend()
 
-        return plt
+        return ax
 
     def plot_bokeh(self, Vds, Vgs, Id_mA):
         """I-V特性をBokehでプロットし、JSONデータとして返す"""
@@ -343,22 +496,15 @@ class JFET_IV_Characteristic(JFET_SimulationBase):
             width=800, height=600
         )
 
-        # Vgsのリスト
-        vgs_absmax = self.get_config("VGS_ABSMAX")
-        vgs_step = self.get_config("VGS_STEP")
-
-        if self.device_type == 'NJF':
-            vgs_list = np.linspace(-vgs_absmax, 0, round(vgs_absmax / vgs_step) + 1)  # -vgs_absmaxから0までの範囲
-        elif self.device_type == 'PJF':
-            vgs_list = np.linspace(vgs_absmax, 0, round(vgs_absmax / vgs_step) + 1)  # vgs_absmaxから0までの範囲
-
         color_cycle = itertools.cycle(color_map)
+        # 曲線の本数が増えても合計の点数が増えないようにする
+        max_points = min(PLOT_MAX_POINTS, max(PLOT_MAX_TOTAL_POINTS // max(len(Vgs), 1), 4))
 
-        # Vgsごとにプロット
-        for vgs_value in vgs_list:
+        # Vgsごとにプロット（行ごとに1本の曲線）
+        for vgs_value, vds_row, id_row in zip(Vgs, Vds, Id_mA):
             color = next(color_cycle)
-            mask = (Vgs >= vgs_value - vgs_step / 2) & (Vgs <= vgs_value + vgs_step / 2)
-            p.line(Vds[mask], Id_mA[mask], legend_label=f'Vgs = {vgs_value:.2f}V', line_width=2, color=color)
+            p.line(*decimate_curve(vds_row, id_row, max_points), legend_label=f'Vgs = {vgs_value:.2f}V',
+                   line_width=2, color=color)
 
         if self.device_type == 'PJF':
             p.x_range.flipped = True
@@ -372,6 +518,7 @@ class JFET_IV_Characteristic(JFET_SimulationBase):
 class JFET_Vgs_Id_Characteristic(JFET_SimulationBase):
 
     _SIMULATION_NAME = 'vgs_id'
+    REQUIRED_TRACES = ['V(n001)', 'Id(J1)']
 
     _CONFIG = {
         "VGS_ABSMAX": 3,
@@ -385,6 +532,10 @@ class JFET_Vgs_Id_Characteristic(JFET_SimulationBase):
         }
     }
 
+    def get_sweep_points(self):
+        """Vgsの掃引"""
+        return count_sweep_points(self.get_config("VGS_ABSMAX"), self.get_config("VGS_STEP"))
+
     def modify_netlist(self):
         super().modify_netlist()
 
@@ -407,29 +558,28 @@ class JFET_Vgs_Id_Characteristic(JFET_SimulationBase):
         Id_mA = Id * 1e3  # ドレイン電流をmA単位に変換
         return Vgs, Id_mA
 
-    def plot_data(self, Vgs, Id_mA):
+    def plot_data(self, ax, Vgs, Id_mA):
         """VgsとIdの特性をプロットする"""
         vgs_absmax = self.get_config("VGS_ABSMAX")
 
-        plt.figure(figsize=(8, 6))
-        plt.plot(Vgs, Id_mA, label=f'Id vs Vgs')
+        ax.plot(Vgs, Id_mA, label=f'Id vs Vgs')
 
-        plt.title("Vgs-Id Characteristic of JFET")
-        plt.xlabel("Vgs (Volts)")
-        plt.ylabel("Id (mA)")
+        ax.set_title("Vgs-Id Characteristic of JFET")
+        ax.set_xlabel("Vgs (Volts)")
+        ax.set_ylabel("Id (mA)")
 
         if self.device_type == 'PJF':
-            plt.gca().invert_xaxis()
-            plt.gca().invert_yaxis()
-            plt.xlim(vgs_absmax, 0)
+            ax.invert_xaxis()
+            ax.invert_yaxis()
+            ax.set_xlim(vgs_absmax, 0)
         elif self.device_type == 'NJF':
-            plt.xlim(-vgs_absmax, 0)
+            ax.set_xlim(-vgs_absmax, 0)
 
-        plt.ylim(0)
-        plt.grid(True)
-        plt.legend()
+        ax.set_ylim(0)
+        ax.grid(True)
+        ax.legend()
 
-        return plt
+        return ax
 
     def plot_bokeh(self, Vgs, Id_mA):
         """VgsとIdの特性をBokehでプロットし、JSONデータとして返す"""
@@ -441,7 +591,7 @@ class JFET_Vgs_Id_Characteristic(JFET_SimulationBase):
         )
 
         # VgsとIdをプロット
-        p.line(Vgs, Id_mA, legend_label="Id vs Vgs", line_width=2, color="blue")
+        p.line(*decimate_curve(Vgs, Id_mA), legend_label="Id vs Vgs", line_width=2, color="blue")
 
         # VGS_ABSMAXを取得
         vgs_absmax = self.get_config("VGS_ABSMAX")
@@ -465,6 +615,7 @@ class JFET_Vgs_Id_Characteristic(JFET_SimulationBase):
 class JFET_Gm_Vgs_Characteristic(JFET_SimulationBase):
 
     _SIMULATION_NAME = 'gm_vgs'
+    REQUIRED_TRACES = ['V(n001)', 'Id(J1)']
 
     _CONFIG = {
         "VGS_ABSMAX": 3,
@@ -479,6 +630,10 @@ class JFET_Gm_Vgs_Characteristic(JFET_SimulationBase):
     }
 
 
+    def get_sweep_points(self):
+        """Vgsの掃引"""
+        return count_sweep_points(self.get_config("VGS_ABSMAX"), self.get_config("VGS_STEP"))
+
     def modify_netlist(self):
         super().modify_netlist()
 
@@ -504,28 +659,27 @@ class JFET_Gm_Vgs_Characteristic(JFET_SimulationBase):
         gm = np.gradient(Id_mA, Vgs)  # Vgsに対するIdの数値微分
         return Vgs, gm
 
-    def plot_data(self, Vgs, gm):
+    def plot_data(self, ax, Vgs, gm):
         """gm-Vgs特性をプロットする"""
-        plt.figure(figsize=(8, 6))
-        plt.plot(Vgs, gm, label=f'gm vs Vgs')
+        ax.plot(Vgs, gm, label=f'gm vs Vgs')
 
-        plt.title("gm-Vgs Characteristic of JFET")
-        plt.xlabel("Vgs (Volts)")
-        plt.ylabel("gm (mS)")
+        ax.set_title("gm-Vgs Characteristic of JFET")
+        ax.set_xlabel("Vgs (Volts)")
+        ax.set_ylabel("gm (mS)")
 
         vgs_absmax = self.get_config("VGS_ABSMAX")
 
         if self.device_type == 'PJF':
-            plt.gca().invert_xaxis()
-            plt.xlim(vgs_absmax, 0)
+            ax.invert_xaxis()
+            ax.set_xlim(vgs_absmax, 0)
         elif self.device_type == 'NJF':
-            plt.xlim(-vgs_absmax, 0)
+            ax.set_xlim(-vgs_absmax, 0)
 
-        plt.ylim(0)
-        plt.grid(True)
-        plt.legend()
+        ax.set_ylim(0)
+        ax.grid(True)
+        ax.legend()
 
-        return plt
+        return ax
 
     def plot_bokeh(self, Vgs, gm):
         """gm-Vgs特性をBokehでプロットし、JSONデータとして返す"""
@@ -537,7 +691,7 @@ class JFET_Gm_Vgs_Characteristic(JFET_SimulationBase):
         )
 
         # gm-Vgsをプロット
-        p.line(Vgs, gm, legend_label="gm vs Vgs", line_width=2, color="blue")
+        p.line(*decimate_curve(Vgs, gm), legend_label="gm vs Vgs", line_width=2, color="blue")
 
         vgs_absmax = self.get_config("VGS_ABSMAX")
 
@@ -557,6 +711,7 @@ class JFET_Gm_Vgs_Characteristic(JFET_SimulationBase):
 class JFET_Gm_Id_Characteristic(JFET_SimulationBase):
 
     _SIMULATION_NAME = 'gm_id'
+    REQUIRED_TRACES = ['V(n001)', 'Id(J1)']
 
     _CONFIG = {
         "VGS_ABSMAX": 3,
@@ -571,6 +726,10 @@ class JFET_Gm_Id_Characteristic(JFET_SimulationBase):
     }
 
 
+    def get_sweep_points(self):
+        """Vgsの掃引"""
+        return count_sweep_points(self.get_config("VGS_ABSMAX"), self.get_config("VGS_STEP"))
+
     def modify_netlist(self):
         super().modify_netlist()
 
@@ -596,26 +755,25 @@ class JFET_Gm_Id_Characteristic(JFET_SimulationBase):
         gm = np.gradient(Id_mA, Vgs)  # Vgsに対するIdの数値微分
         return Id_mA, gm
 
-    def plot_data(self, Id_mA, gm):
+    def plot_data(self, ax, Id_mA, gm):
         """gm-Vgs特性をプロットする"""
-        plt.figure(figsize=(8, 6))
-        plt.plot(Id_mA, np.abs(gm), label=f'gm vs Id')  # |gm|（mS単位）でプロット
+        ax.plot(Id_mA, np.abs(gm), label=f'gm vs Id')  # |gm|（mS単位）でプロット
 
-        plt.title("gm-Id Characteristic of JFET")
-        plt.xlabel("Id (mA)")  # ドレイン電流をmA単位
-        plt.ylabel("gm (mS)")  # フィールド・トランスコンダクタンス（ミリジーメンス）
+        ax.set_title("gm-Id Characteristic of JFET")
+        ax.set_xlabel("Id (mA)")  # ドレイン電流をmA単位
+        ax.set_ylabel("gm (mS)")  # フィールド・トランスコンダクタンス（ミリジーメンス）
 
         if self.device_type == 'PJF':
-            plt.gca().invert_xaxis()
-            plt.xlim([max(Id_mA), min(Id_mA)]) 
+            ax.invert_xaxis()
+            ax.set_xlim([max(Id_mA), min(Id_mA)]) 
         elif self.device_type == 'NJF':
-            plt.xlim([min(Id_mA), max(Id_mA)])  # Idの最小値と最大値で範囲を設定
+            ax.set_xlim([min(Id_mA), max(Id_mA)])  # Idの最小値と最大値で範囲を設定
 
-        plt.ylim([min(np.abs(gm)), max(np.abs(gm))])  # gmの絶対値で範囲を設定
-        plt.grid(True)
-        plt.legend()
+        ax.set_ylim([min(np.abs(gm)), max(np.abs(gm))])  # gmの絶対値で範囲を設定
+        ax.grid(True)
+        ax.legend()
 
-        return plt
+        return ax
 
 
     def plot_bokeh(self, Id_mA, gm):
@@ -628,7 +786,7 @@ class JFET_Gm_Id_Characteristic(JFET_SimulationBase):
         )
 
         # gm-Idをプロット（絶対値gmを使用）
-        p.line(Id_mA, np.abs(gm), legend_label="gm vs Id", line_width=2, color="green")
+        p.line(*decimate_curve(Id_mA, np.abs(gm)), legend_label="gm vs Id", line_width=2, color="green")
 
         if self.device_type == 'PJF':
             p.x_range.flipped = True
@@ -1,14 +1,125 @@
 import os
 import json
+import time
+import hashlib
+import zipfile
+from io import BytesIO
 from datetime import datetime
 from redis import Redis
 
+try:
+    from simulation.metrics import (
+        MetricsWriter, collect_redis_metrics, observe_histogram, count_job, count_coalesced, publish_job_event,
+        record_eviction, discard_result, evict_results,
+        JOB_QUEUES, JOB_DOORBELL, FINISHED_JOBS, INFLIGHT_PREFIX, JOB_EVENTS, REDIS_RESULT_PREFIX, RESULT_TTL,
+        RESULT_MAX_BYTES, RESULT_INDEX, RESULT_SIZES, RESULT_BYTES, RESULT_REFS, RESULT_CACHE_BYTES,
+        RESULT_EVICTION_STATS, RESULT_EVICTION_LOG,
+    )
+except ImportError:  # simulationディレクトリ内から直接実行する場合
+    from metrics import (
+        MetricsWriter, collect_redis_metrics, observe_histogram, count_job, count_coalesced, publish_job_event,
+        record_eviction, discard_result, evict_results,
+        JOB_QUEUES, JOB_DOORBELL, FINISHED_JOBS, INFLIGHT_PREFIX, JOB_EVENTS, REDIS_RESULT_PREFIX, RESULT_TTL,
+        RESULT_MAX_BYTES, RESULT_INDEX, RESULT_SIZES, RESULT_BYTES, RESULT_REFS, RESULT_CACHE_BYTES,
+        RESULT_EVICTION_STATS, RESULT_EVICTION_LOG,
+    )
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 同じ内容のジョブが待機中・実行中であれば相乗りし、そうでなければ自分が実行中のジョブとして登録する
+# 相乗りする場合は一覧への登録とメタデータの保存も同時に行う（実行元の完了と競合しないようアトミックに行う）
+# KEYS: inflight:<キャッシュキー>, 新しいジョブのメタデータ, ジョブのインデックス,
+#       実行元のメタデータ, 実行元の相乗りリスト, 通常キュー, 優先キュー
+# ARGV: 新しいジョブID, 実行元のジョブID（なければ空文字）, 実行元として登録するメタデータ(JSON),
+#       相乗りとして登録するメタデータ(JSON), 保持秒数, 優先度, インデックスのスコア
+# 戻り値: 1 = 相乗りした, 0 = 実行元として登録した, -1 = 実行元が変わったので読み直す
+ATTACH_INFLIGHT_SCRIPT = """
+local primary = redis.call('GET', KEYS[1])
+if (primary or '') ~= ARGV[2] then
+    return -1
+end
+if primary then
+    local meta = redis.call('GET', KEYS[4])
+    if meta then
+        local job = cjson.decode(meta)
+        local status = job['status']
+        if status == 'pending' or status == 'running' then
+            redis.call('RPUSH', KEYS[5], ARGV[1])
+            redis.call('EXPIRE', KEYS[5], ARGV[5])
+            redis.call('SET', KEYS[2], ARGV[4])
+            redis.call('ZADD', KEYS[3], ARGV[7], ARGV[1])
+            -- 画面からの要求が一括実行のジョブに相乗りした場合は優先キューに移す
+            if status == 'pending' and ARGV[6] == 'interactive' then
+                local score = redis.call('ZSCORE', KEYS[6], primary)
+                if score then
+                    redis.call('ZREM', KEYS[6], primary)
+                    redis.call('ZADD', KEYS[7], score, primary)
+                    -- ジョブ一覧とキューでの待ち時間の集計にも移動後のキューが反映されるようにする
+                    job['priority'] = 'interactive'
+                    redis.call('SET', KEYS[4], cjson.encode(job))
+                end
+            end
+            return 1
+        end
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[5])
+redis.call('SET', KEYS[2], ARGV[3])
+return 0
+"""
+
+
+class JobCostError(ValueError):
+    """見積もったコストが上限を超えたジョブ（キューには積まない）"""
+
+
 class JobModel:
     def __init__(self, redis_host="localhost", redis_port=6379, redis_db=0):
         self.redis = Redis(host=redis_host, port=redis_port, db=redis_db, decode_responses=False)
         self.REDIS_JOB_PREFIX = "job:"
-        self.REDIS_RESULT_PREFIX = "result:"
+        self.REDIS_RESULT_PREFIX = REDIS_RESULT_PREFIX
+        self.REDIS_JOB_INDEX = "job_index"  # ジョブID -> 作成時刻 (ZSET)
+        self.FINISHED_JOBS = FINISHED_JOBS  # 終了したジョブID -> 終了時刻 (ZSET、ワーカーが追加する)
         self.MAX_JOBS = 25
+        self.JOB_DONE_TTL = 300  # 完了通知リストの保持秒数
+        self.INFLIGHT_PREFIX = INFLIGHT_PREFIX  # キャッシュキー -> 待機中・実行中のジョブID
+        self.INFLIGHT_TTL = 3600  # ジョブが失われた場合でも相乗りの登録が残り続けないようにする
+        self.JOB_EVENTS = JOB_EVENTS  # ジョブの状態遷移 (STREAM)
+        # 結果の保存形式 (zip: 1つのZIP, files: ファイルごとにハッシュのフィールドとして保存)
+        self.RESULT_FORMATS = ("zip", "files")
+        # 優先度ごとのキュー（ワーカーは上から順に取り出す）
+        # ZSET: スコアは投入時刻 + 見積もり時間 x 重みで、同じキューの中では短いジョブが先に実行される
+        self.JOB_QUEUES = JOB_QUEUES
+        self.JOB_DOORBELL = JOB_DOORBELL  # 待機中のワーカーを起こすためのLIST
+        self.JOB_DOORBELL_MAX = 64
+        self.QUEUE_COST_WEIGHT = float(os.environ.get("QUEUE_COST_WEIGHT", 10))
+        # 解析点の数による振り分け（BULKを超えたらbulkキューへ、MAXを超えたら拒否）
+        self.BULK_JOB_POINTS = int(os.environ.get("BULK_JOB_POINTS", 100000))
+        self.MAX_JOB_POINTS = int(os.environ.get("MAX_JOB_POINTS", 5000000))
+        # シミュレーション結果キャッシュ（ネットリストのハッシュ + シミュレータのバージョンで識別）
+        self.RESULT_CACHE_PREFIX = "result_cache:"
+        self.RESULT_CACHE_INDEX = "result_cache_index"  # キャッシュキー -> 最終アクセス時刻 (ZSET)
+        self.RESULT_CACHE_SIZES = "result_cache_sizes"  # キャッシュキー -> バイト数 (HASH)
+        self.RESULT_CACHE_BYTES = RESULT_CACHE_BYTES  # キャッシュ全体のバイト数
+        self.RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+        self.RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 3600))
+        # result:* キーの保持期間とメモリ予算（ワーカーと同じ設定を使う）
+        self.RESULT_TTL = RESULT_TTL
+        self.RESULT_MAX_BYTES = RESULT_MAX_BYTES
+        self.RESULT_INDEX = RESULT_INDEX  # 結果キー -> 最終アクセス時刻 (ZSET)
+        self.RESULT_SIZES = RESULT_SIZES  # 結果キー -> バイト数 (HASH)
+        self.RESULT_BYTES = RESULT_BYTES  # 結果全体のバイト数
+        self.RESULT_REFS = RESULT_REFS  # 結果キー -> 参照している終了したジョブの数 (HASH)
+        self.RESULT_EVICTION_STATS = RESULT_EVICTION_STATS  # 削除理由ごとの件数とバイト数 (HASH)
+        self.RESULT_EVICTION_LOG = RESULT_EVICTION_LOG  # 最近削除された結果 (LIST)
+        # 処理段階ごとの所要時間（ジョブごとのハッシュと、段階ごとに直近の値を残すリスト）
+        self.TIMING_PREFIX = "timings:"
+        self.TIMING_SAMPLES = 1000
+        self.TIMING_STAGES = ("build", "enqueue", "queue_wait", "simulation", "launch_overhead", "extract", "store", "fetch", "load", "plot")
+        self.attach_inflight = self.redis.register_script(ATTACH_INFLIGHT_SCRIPT)
         self.SIMULATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
         os.makedirs(self.SIMULATION_DIR, exist_ok=True)
 
@@ -26,52 +137,264 @@ class JobModel:
         return self.redis.get(file_key)
 
     def get_job_result(self, job_id):
-        """ジョブの結果を取得"""
-        result_key = f"{self.REDIS_RESULT_PREFIX}{job_id}"
-        return self.redis.get(result_key)
-
-    def fetch_stream_message(self, stream_name, job_id, timeout=30):
-        last_id = '0-0'  # 最初のストリームID
-        read_count = 25
-        start_time = datetime.now()
-        
-        while (datetime.now() - start_time).seconds < timeout:
-            # XREADでlast_idから次のエントリを取得
-            messages = self.redis.xread({stream_name: last_id}, block=1000, count=read_count)
-            if messages:
-                for stream, entries in messages:
-                    for message_id, data in entries:
-                        if data[b"job_id"].decode('utf-8') == job_id:
-                            return True
-                        # 最新のIDを更新
-                        last_id = message_id
-        return False
+        """ジョブの結果をZIPとして取得（ファイルごとに保存された結果はZIPにまとめ直す）"""
+        job_data = self.get_job_meta(job_id) or {}
+        result_key = job_data.get("result_key") or f"{self.REDIS_RESULT_PREFIX}{job_id}"
+        result = self.read_result(result_key, job_data.get("result_format", "zip"))
+        if isinstance(result, dict):
+            return self.artifacts_to_zip(result)
+        return result
+
+    def read_result(self, result_key, result_format):
+        """
+        Redisから結果を読み込む。
+
+        Returns:
+            bytes: result_format="zip" の場合はZIPデータ。
+            dict: result_format="files" の場合はファイル名 -> 展開済みのバイナリデータ。
+            None: 結果が存在しない場合。
+        """
+        if result_format != "files":
+            result = self.redis.get(result_key)
+            if result:
+                self.touch_result(result_key)
+            return result
+
+        fields = self.redis.hgetall(result_key)
+        if not fields:
+            return None
+        self.touch_result(result_key)
+
+        codec = fields.pop(b"__codec__", b"none").decode('utf-8')
+        if codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read this result")
+            decompressor = zstandard.ZstdDecompressor()
+            return {name.decode('utf-8'): decompressor.decompress(data) for name, data in fields.items()}
+        return {name.decode('utf-8'): data for name, data in fields.items()}
+
+    def touch_result(self, result_key):
+        """取得された結果の最終アクセス時刻を更新し、保持期間を延長する"""
+        if not result_key.startswith(self.REDIS_RESULT_PREFIX):
+            return  # キャッシュの結果はキャッシュ側で管理する
+        pipeline = self.redis.pipeline()
+        pipeline.zadd(self.RESULT_INDEX, {result_key: time.time()}, xx=True)
+        pipeline.expire(result_key, self.RESULT_TTL)
+        pipeline.execute()
+
+    def get_result_stats(self):
+        """結果とキャッシュのメモリ使用量、削除の統計を取得"""
+        self.sweep_expired_cached_results()
+        pipeline = self.redis.pipeline()
+        pipeline.get(self.RESULT_BYTES)
+        pipeline.zcard(self.RESULT_INDEX)
+        pipeline.get(self.RESULT_CACHE_BYTES)
+        pipeline.zcard(self.RESULT_CACHE_INDEX)
+        pipeline.hgetall(self.RESULT_EVICTION_STATS)
+        pipeline.lrange(self.RESULT_EVICTION_LOG, 0, -1)
+        result_bytes, result_count, cache_bytes, cache_count, stats, log = pipeline.execute()
+
+        evictions = {}
+        for field, value in stats.items():
+            reason, _, metric = field.decode('utf-8').rpartition(":")
+            evictions.setdefault(reason, {"count": 0, "bytes": 0})[metric] = int(value)
+
+        return {
+            "results": {
+                "bytes": int(result_bytes or 0),
+                "count": result_count,
+                "max_bytes": self.RESULT_MAX_BYTES,
+                "ttl": self.RESULT_TTL,
+            },
+            "cache": {
+                "bytes": int(cache_bytes or 0),
+                "count": cache_count,
+                "max_bytes": self.RESULT_CACHE_MAX_BYTES,
+                "ttl": self.RESULT_CACHE_TTL,
+            },
+            "evictions": evictions,
+            "recent_evictions": [json.loads(entry.decode('utf-8')) for entry in log],
+        }
+
+    @staticmethod
+    def find_artifact(artifacts, extension, stem=None):
+        """結果ファイルの中から拡張子（とファイル名）が一致するデータを取得"""
+        if stem is not None:
+            return artifacts.get(f"{stem}{extension}")
+        for name, data in artifacts.items():
+            if name.endswith(extension):
+                return data
+        return None
+
+    @staticmethod
+    def artifacts_to_zip(artifacts):
+        """ファイルごとの結果をダウンロード用のZIPにまとめる"""
+        zip_buffer = BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for name, data in artifacts.items():
+                zip_file.writestr(name, data)
+        return zip_buffer.getvalue()
+
+    def get_simulator_version(self):
+        """ワーカーが登録したシミュレータのバージョンを取得"""
+        version = self.redis.get("simulator_version")
+        return version.decode('utf-8') if version else "unknown"
+
+    def compute_cache_key(self, binary_data, filename, result_format="files", traces=None, trace_dtype="float64"):
+        """ネットリストの内容とシミュレータのバージョンからキャッシュキーを生成"""
+        digest = hashlib.sha256()
+        digest.update(self.get_simulator_version().encode('utf-8'))
+        digest.update(b"\0")
+        # 保存形式が異なる結果は別のエントリとして扱う
+        digest.update(result_format.encode('utf-8'))
+        digest.update(b"\0")
+        # 抽出する波形が異なる結果も別のエントリとして扱う
+        if traces is not None:
+            digest.update(json.dumps([sorted(traces), trace_dtype]).encode('utf-8'))
+            digest.update(b"\0")
+        # .ascと.netでは処理が異なるため拡張子も含める
+        digest.update(os.path.splitext(filename)[1].lower().encode('utf-8'))
+        digest.update(b"\0")
+        digest.update(binary_data)
+        return digest.hexdigest()
+
+    def copy_cached_result(self, cache_key, result_key):
+        """
+        キャッシュに結果があればジョブの結果キーに複製する（キャッシュのLRUの順位と保持期間も更新）。
+        結果を取得する前にキャッシュから削除されても、ジョブの結果は失われない。
+
+        Returns:
+            bool: キャッシュに結果があった場合はTrue。
+        """
+        cache_result_key = f"{self.RESULT_CACHE_PREFIX}{cache_key}"
+        dump = self.redis.dump(cache_result_key)
+        if dump is None:
+            return False
+
+        pipeline = self.redis.pipeline()
+        pipeline.zadd(self.RESULT_CACHE_INDEX, {cache_key: time.time()}, xx=True)
+        pipeline.expire(cache_result_key, self.RESULT_CACHE_TTL)
+        pipeline.restore(result_key, self.RESULT_TTL * 1000, dump, replace=True)
+        pipeline.zadd(self.RESULT_INDEX, {result_key: time.time()})
+        pipeline.hset(self.RESULT_SIZES, result_key, len(dump))
+        pipeline.incrby(self.RESULT_BYTES, len(dump))
+        pipeline.execute()
+
+        evict_results(self.redis, keep=result_key)
+        return True
+
+    def store_cached_result(self, cache_key, result_key):
+        """ジョブの結果をキャッシュへ複製し、メモリ予算を超えた分を古い順に削除"""
+        dump = self.redis.dump(result_key)
+        if dump is None or len(dump) > self.RESULT_CACHE_MAX_BYTES:
+            return
+
+        cache_result_key = f"{self.RESULT_CACHE_PREFIX}{cache_key}"
+        previous_size = self.redis.hget(self.RESULT_CACHE_SIZES, cache_key)
+
+        pipeline = self.redis.pipeline()
+        pipeline.restore(cache_result_key, self.RESULT_CACHE_TTL * 1000, dump, replace=True)
+        pipeline.zadd(self.RESULT_CACHE_INDEX, {cache_key: time.time()})
+        pipeline.hset(self.RESULT_CACHE_SIZES, cache_key, len(dump))
+        pipeline.incrby(self.RESULT_CACHE_BYTES, len(dump) - int(previous_size or 0))
+        pipeline.execute()
+
+        self.sweep_expired_cached_results()
+        self.evict_cached_results()
+
+    def evict_cached_results(self):
+        """キャッシュの合計サイズが予算内に収まるまでLRU順に削除"""
+        while int(self.redis.get(self.RESULT_CACHE_BYTES) or 0) > self.RESULT_CACHE_MAX_BYTES:
+            oldest = self.redis.zpopmin(self.RESULT_CACHE_INDEX)
+            if not oldest:
+                self.redis.set(self.RESULT_CACHE_BYTES, 0)
+                break
+            self.discard_cached_result(oldest[0][0].decode('utf-8'), "cache_lru")
+
+    def sweep_expired_cached_results(self):
+        """TTLで消えたキャッシュをインデックスとサイズの集計から外す"""
+        # 取得されるたびにTTLを延長しているので、最終アクセスからTTL以上経ったものは消えている
+        expired = self.redis.zrangebyscore(self.RESULT_CACHE_INDEX, 0, time.time() - self.RESULT_CACHE_TTL)
+        for cache_key in expired:
+            cache_key = cache_key.decode('utf-8')
+            if not self.redis.exists(f"{self.RESULT_CACHE_PREFIX}{cache_key}"):
+                self.discard_cached_result(cache_key, "cache_expired")
+
+    def discard_cached_result(self, cache_key, reason):
+        """キャッシュのエントリを削除してサイズの集計から外し、削除理由ごとの統計に記録する"""
+        size = int(self.redis.hget(self.RESULT_CACHE_SIZES, cache_key) or 0)
+        pipeline = self.redis.pipeline()
+        pipeline.delete(f"{self.RESULT_CACHE_PREFIX}{cache_key}")
+        pipeline.zrem(self.RESULT_CACHE_INDEX, cache_key)
+        pipeline.hdel(self.RESULT_CACHE_SIZES, cache_key)
+        pipeline.decrby(self.RESULT_CACHE_BYTES, size)
+        record_eviction(pipeline, f"{self.RESULT_CACHE_PREFIX}{cache_key}", size, reason)
+        pipeline.execute()
+
+    def wait_for_job(self, job_id, timeout=30):
+        """
+        ジョブ専用の完了通知リストをBLPOPで待機する。
+        待機中のクライアントはこのジョブの完了時にのみ起こされる。
+
+        Returns:
+            str: 完了時のステータス ("completed" または "failed")。
+            None: タイムアウトした場合。
+        """
+        done_key = f"{self.REDIS_JOB_PREFIX}{job_id}:done"
+        item = self.redis.blpop(done_key, timeout=timeout)
+        if item is None:
+            return None
+
+        self.restore_done_notification(done_key, item[1])
+        return item[1].decode('utf-8')
+
+    def restore_done_notification(self, done_key, status):
+        """同じジョブを待っている他のクライアントも起こせるように通知を戻す"""
+        pipeline = self.redis.pipeline()
+        pipeline.rpush(done_key, status)
+        pipeline.expire(done_key, self.JOB_DONE_TTL)
+        pipeline.execute()
+
+    def get_completed_result(self, job_id, job_data):
+        """完了したジョブの結果を取得し、新しく計算された結果はキャッシュに登録"""
+        if job_data.get("status") != "completed":
+            return None
+
+        result_key = job_data.get("result_key") or f"{self.REDIS_RESULT_PREFIX}{job_id}"
+        start_time = time.perf_counter()
+        result = self.read_result(result_key, job_data.get("result_format", "zip"))
+        if not result:
+            return None
+        self.record_timings(job_id, {"fetch": time.perf_counter() - start_time})
+
+        cache_key = job_data.get("cache_key")
+        if cache_key and not job_data.get("cached"):
+            self.store_cached_result(cache_key, result_key)
+
+        return result
 
     def get_job_result_with_notification(self, job_id, timeout=30):
         """
-        Redis Streamsを使用してジョブの結果を取得。
-        タイムアウト期間内に通知がない場合は、直接Redisキーを確認。
+        ジョブ専用の完了通知を待ってジョブの結果を取得。
+        タイムアウト期間内に通知がない場合はNoneを返す。
 
         Args:
             job_id (str): ジョブID。
             timeout (int): タイムアウト秒数。
 
         Returns:
-            bytes: ジョブ結果のバイナリデータ。
+            bytes or dict: ジョブ結果（形式はread_resultを参照）。
             None: 結果が存在しない場合。
         """
-        result_key = f"{self.REDIS_RESULT_PREFIX}{job_id}"
-        stream_name = "job_notifications"
+        # キャッシュから返されたジョブなどは既に完了しているので待たない
+        job_data = self.get_job_meta(job_id) or {}
+        if job_data.get("status") not in ("completed", "failed"):
+            if not self.wait_for_job(job_id, timeout):
+                # タイムアウト後も結果がない場合Noneを返す
+                return None
+            job_data = self.get_job_meta(job_id) or {}
 
-        # Redis Streamsからメッセージを取得
-        if self.fetch_stream_message(stream_name, job_id, timeout):
-            # メッセージが見つかった場合、結果を取得
-            result = self.redis.get(result_key)
-            if result:
-                return result
-
-        # タイムアウト後も結果がない場合Noneを返す
-        return None
+        return self.get_completed_result(job_id, job_data)
 
     def generate_job_id_from_timestamp(self, base_name):
         """ジョブIDを生成"""
@@ -80,70 +403,390 @@ class JobModel:
         timestamp = datetime.now().strftime("%b_%d_%H%M")
         return f"{job_prefix_padded}_{base_name}_{timestamp}"
 
-    def create_job(self, uploaded_file_path):
-        """ジョブを作成（Redisパイプラインを使用）"""
-        base_name = os.path.splitext(os.path.basename(uploaded_file_path))[0]
-        job_id = self.generate_job_id_from_timestamp(base_name)
-
+    def create_job(self, uploaded_file_path, priority="batch", result_format="files", traces=None, trace_dtype="float64",
+                   context=None):
+        """ファイルに保存されたネットリストからジョブを作成（引数はcreate_job_from_dataを参照）"""
         # アップロードされたファイルを読み込む
         with open(uploaded_file_path, "rb") as file:
             binary_data = file.read()
 
+        return self.create_job_from_data(os.path.basename(uploaded_file_path), binary_data, priority, result_format,
+                                         traces, trace_dtype, context)
+
+    def create_job_from_data(self, filename, binary_data, priority="batch", result_format="files", traces=None,
+                             trace_dtype="float64", context=None, on_complete=None, cost=None):
+        """メモリ上のネットリストからジョブを作成（Redisパイプラインを使用）
+
+        Args:
+            filename (str): ネットリストのファイル名（ワーカーはこの名前で保存して実行する）。
+            binary_data (bytes): ネットリストの内容。
+            priority (str): "interactive"（画面からの即時実行）または "batch"（一括実行）。
+            result_format (str): 結果の保存形式 ("files" または "zip")。
+            traces (list): ワーカーで抽出する波形名。指定すると.rawの代わりに.tracesが返される。
+            trace_dtype (str): 抽出した波形の保存形式 ("float64" または "float32")。
+            context (dict): 結果を受け取る側が後で使う情報（メタデータにそのまま保存される）。
+            on_complete (dict): 完了時にワーカーが投入するCeleryタスク {"task": タスク名, "kwargs": 引数}。
+                タスクにはjob_idとstatusが追加で渡される（キャッシュヒットの場合は投入されない）。
+            cost (dict): 設定から見積もったコスト {"points": 解析点の数, "seconds": 実行時間}。
+                キューの順序と振り分けに使う（見積もりがなければ投入順）。
+        """
+        start_time = time.perf_counter()
+        filename = os.path.basename(filename)
+        base_name = os.path.splitext(filename)[0]
+
         # ジョブのメタデータ
         job_data = {
             "status": "pending",
             "error": None,
-            "file_path": os.path.basename(uploaded_file_path),
+            "file_path": filename,
+            "result_format": result_format,
+            "cache_key": self.compute_cache_key(binary_data, filename, result_format, traces, trace_dtype),
+        }
+        if traces is not None:
+            job_data.update({"traces": list(traces), "trace_dtype": trace_dtype})
+        if context is not None:
+            job_data["context"] = context
+        if on_complete is not None:
+            job_data["on_complete"] = on_complete
+        if cost is not None:
+            job_data["cost"] = cost
+
+        job_id = self.submit_job(base_name, binary_data, job_data, priority)
+        self.record_timings(job_id, {"enqueue": time.perf_counter() - start_time})
+        return job_id
+
+    def create_bundle_job(self, netlists, base_name="bundle", priority="batch", result_format="files",
+                          traces=None, trace_dtype="float64", on_complete=None, cost=None):
+        """
+        複数のネットリストを1つのジョブとして作成する。
+        キューの往復と結果の転送が1回で済み、同じ内容のネットリストは1回だけ実行される。
+        結果には各ネットリストの名前で.rawと.logが格納される。
+
+        Args:
+            netlists (list): ネットリストのパス、または (ファイル名, 内容のbytes) のリスト。
+            base_name (str): ジョブIDに含める名前。
+            priority (str): "interactive" または "batch"。
+            result_format (str): 結果の保存形式 ("files" または "zip")。
+            traces (list): ワーカーで抽出する波形名（全メンバー共通）。
+            trace_dtype (str): 抽出した波形の保存形式 ("float64" または "float32")。
+            on_complete (dict): 完了時にワーカーが投入するCeleryタスク（create_job_from_dataと同じ）。
+            cost (dict): 全メンバーの見積もりコストの合計（create_job_from_dataと同じ）。
+        """
+        start_time = time.perf_counter()
+        entries = []
+        for netlist in netlists:
+            if isinstance(netlist, tuple):
+                filename, netlist_data = netlist
+            else:
+                filename = netlist
+                with open(netlist, "rb") as file:
+                    netlist_data = file.read()
+            entries.append((os.path.basename(filename), netlist_data))
+
+        members = [member for member, _ in entries]
+        if len(set(members)) != len(members):
+            raise ValueError("Bundle members must have unique file names")
+
+        # ネットリストをZIPにまとめる（キャッシュキーは名前と内容から計算）
+        bundle_buffer = BytesIO()
+        cache_source = b""
+        with zipfile.ZipFile(bundle_buffer, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            for member, netlist_data in entries:
+                bundle.writestr(member, netlist_data)
+                cache_source += member.encode('utf-8') + b"\0" + netlist_data + b"\0"
+
+        job_data = {
+            "status": "pending",
+            "error": None,
+            "file_path": f"{base_name}.zip",
+            "kind": "bundle",
+            "members": members,
+            "result_format": result_format,
+            "cache_key": self.compute_cache_key(cache_source, f"{base_name}.zip", result_format, traces, trace_dtype),
         }
+        if traces is not None:
+            job_data.update({"traces": list(traces), "trace_dtype": trace_dtype})
+        if on_complete is not None:
+            job_data["on_complete"] = on_complete
+        if cost is not None:
+            job_data["cost"] = cost
+
+        job_id = self.submit_job(base_name, bundle_buffer.getvalue(), job_data, priority)
+        self.record_timings(job_id, {"enqueue": time.perf_counter() - start_time})
+        return job_id
+
+    def route_by_cost(self, cost, priority):
+        """見積もりコストが上限を超えたジョブは拒否し、大きいジョブはbulkキューに振り分ける"""
+        if not cost:
+            return priority
+        if cost["points"] > self.MAX_JOB_POINTS:
+            raise JobCostError(f"Estimated sweep of {cost['points']} points exceeds the limit of {self.MAX_JOB_POINTS}")
+        if cost["points"] > self.BULK_JOB_POINTS:
+            return "bulk"
+        return priority
+
+    def get_queue_score(self, job_data):
+        """キューでのスコア（投入時刻に見積もり時間の重みを加え、短いジョブを先に、長いジョブも待たせすぎない）"""
+        cost = job_data.get("cost") or {}
+        return job_data["created_at"] + self.QUEUE_COST_WEIGHT * cost.get("seconds", 0)
+
+    def register_inflight(self, job_id, job_data, priority):
+        """
+        同じ内容のジョブが待機中・実行中であれば相乗りし（job_dataにattached_toを追加）、
+        そうでなければ実行元として登録する。
+
+        Returns:
+            bool: 相乗りした場合はTrue（メタデータとインデックスへの登録も済んでいる）。
+        """
+        inflight_key = f"{self.INFLIGHT_PREFIX}{job_data['cache_key']}"
+        while True:
+            primary = self.redis.get(inflight_key)
+            primary_job_id = primary.decode('utf-8') if primary else ""
+            # 実行元がなければ相乗り用のキーは使われないので自分のキーを渡しておく
+            primary_key = f"{self.REDIS_JOB_PREFIX}{primary_job_id or job_id}"
+            follower_data = {**job_data, "attached_to": primary_job_id}
+            attached = self.attach_inflight(
+                keys=[inflight_key, f"{self.REDIS_JOB_PREFIX}{job_id}:meta", self.REDIS_JOB_INDEX,
+                      f"{primary_key}:meta", f"{primary_key}:followers",
+                      self.JOB_QUEUES["batch"], self.JOB_QUEUES["interactive"]],
+                args=[job_id, primary_job_id, json.dumps(job_data), json.dumps(follower_data),
+                      self.INFLIGHT_TTL, priority, time.time()],
+            )
+            # 読み込んでからスクリプトを実行するまでに実行元が変わった場合は読み直す
+            if attached != -1:
+                break
+        if attached:
+            job_data["attached_to"] = primary_job_id
+        return bool(attached)
+
+    def submit_job(self, base_name, binary_data, job_data, priority="batch"):
+        """
+        ジョブを登録してキューに積む。
+        キャッシュにあれば完了済みとして登録し、同じ内容のジョブが待機中・実行中であれば
+        そのジョブに相乗りする（どちらの場合もキューには積まない）。
+        """
+        if priority not in self.JOB_QUEUES:
+            raise ValueError(f"Invalid priority: {priority}")
+        if job_data.get("result_format") not in self.RESULT_FORMATS:
+            raise ValueError(f"Invalid result format: {job_data.get('result_format')}")
+        priority = self.route_by_cost(job_data.get("cost"), priority)
+
+        job_id = self.generate_job_id_from_timestamp(base_name)
+        job_data["priority"] = priority
+        job_data["created_at"] = time.time()  # キューでの待ち時間の計測に使う
+        result_key = f"{self.REDIS_RESULT_PREFIX}{job_id}"
+        cached = self.copy_cached_result(job_data["cache_key"], result_key)
+
+        attached = False
+        if not cached:
+            # 実行中のジョブとして登録できればメタデータも同時に保存される
+            attached = self.register_inflight(job_id, job_data, priority)
 
         # Redisパイプラインで一括保存
         pipeline = self.redis.pipeline()
-        pipeline.set(f"{self.REDIS_JOB_PREFIX}{job_id}:meta", json.dumps(job_data))
-        pipeline.set(f"{self.REDIS_JOB_PREFIX}{job_id}:file", binary_data)
-        pipeline.rpush("job_queue", job_id)
+        if cached:
+            # キャッシュヒット: キューには積まずに、複製した結果で完了済みのジョブとして登録
+            job_data.update(status="completed", cached=True, result_key=result_key)
+            pipeline.set(f"{self.REDIS_JOB_PREFIX}{job_id}:meta", json.dumps(job_data))
+            pipeline.zadd(self.REDIS_JOB_INDEX, {job_id: time.time()})
+            pipeline.zadd(self.FINISHED_JOBS, {job_id: time.time()})
+            pipeline.hincrby(self.RESULT_REFS, result_key, 1)
+            count_job(pipeline, "cached")
+        elif attached:
+            # 相乗り: 実行中のジョブが終わるとワーカーがこのジョブも同じ結果で完了させる
+            count_coalesced(pipeline, priority)
+        else:
+            pipeline.set(f"{self.REDIS_JOB_PREFIX}{job_id}:file", binary_data)
+            pipeline.zadd(self.REDIS_JOB_INDEX, {job_id: time.time()})
+            pipeline.zadd(self.JOB_QUEUES[priority], {job_id: self.get_queue_score(job_data)})
+            pipeline.rpush(self.JOB_DOORBELL, 1)  # 待機中のワーカーを起こす
+            pipeline.ltrim(self.JOB_DOORBELL, 0, self.JOB_DOORBELL_MAX - 1)
+        publish_job_event(pipeline, job_id, job_data["status"])
         pipeline.execute()
 
-        # 古いジョブを削除
-        all_jobs = self.redis.keys(f"{self.REDIS_JOB_PREFIX}*:meta")
-        all_jobs_str = [key.decode('utf-8') for key in all_jobs]
-        all_jobs_str.sort()
-
-        # 必要な数だけ削除
-        while len(all_jobs_str) > self.MAX_JOBS:
-            oldest_job_key = all_jobs_str.pop(0)  # 最も古いジョブを取得してリストから削除
-            pipeline = self.redis.pipeline()
-            pipeline.delete(oldest_job_key.replace(":meta", ":file"))  # ファイルキーを削除
-            pipeline.delete(oldest_job_key)  # メタデータキーを削除
-            pipeline.execute()
+        self.trim_jobs()
 
         return job_id
 
+    def trim_jobs(self):
+        """
+        ジョブ数がMAX_JOBSを超えた分を、終了したジョブ（completed/failed）から終了が古い順に削除する。
+        待機中・実行中のジョブは完了時に続きの処理（on_complete）が実行されるので削除しない。
+        """
+        excess = self.redis.zcard(self.REDIS_JOB_INDEX) - self.MAX_JOBS
+        if excess <= 0:
+            return
+
+        oldest_job_ids = [job_id.decode('utf-8') for job_id in self.redis.zrange(self.FINISHED_JOBS, 0, excess - 1)]
+        if not oldest_job_ids:
+            return
+        job_values = self.redis.mget([f"{self.REDIS_JOB_PREFIX}{job_id}:meta" for job_id in oldest_job_ids])
+
+        pipeline = self.redis.pipeline()
+        for oldest_job_id in oldest_job_ids:
+            pipeline.delete(f"{self.REDIS_JOB_PREFIX}{oldest_job_id}:file")  # ファイルキーを削除
+            pipeline.delete(f"{self.REDIS_JOB_PREFIX}{oldest_job_id}:meta")  # メタデータキーを削除
+            pipeline.delete(f"{self.REDIS_JOB_PREFIX}{oldest_job_id}:timings")  # 所要時間を削除
+        pipeline.zrem(self.REDIS_JOB_INDEX, *oldest_job_ids)
+        pipeline.zrem(self.FINISHED_JOBS, *oldest_job_ids)
+        for oldest_job_id in oldest_job_ids:
+            publish_job_event(pipeline, oldest_job_id, "removed")
+        pipeline.execute()
+
+        # 削除したジョブの結果も残さない（相乗りしたジョブがまだ参照している結果は残す）
+        for value in job_values:
+            result_key = json.loads(value.decode('utf-8')).get("result_key") if value else None
+            if not result_key or not result_key.startswith(self.REDIS_RESULT_PREFIX):
+                continue  # キャッシュの結果はキャッシュ側で管理する
+            if self.redis.hincrby(self.RESULT_REFS, result_key, -1) > 0:
+                continue
+            self.redis.hdel(self.RESULT_REFS, result_key)
+            if self.redis.zscore(self.RESULT_INDEX, result_key) is not None:
+                discard_result(self.redis, result_key, "trimmed")
+
     def get_all_jobs(self):
-        """すべてのジョブをRedisから取得（MGET使用）"""
+        """すべてのジョブをRedisから取得（インデックス + MGET使用）"""
         all_jobs = {}
-        job_keys = self.redis.keys(f"{self.REDIS_JOB_PREFIX}*:meta")
-        
-        if not job_keys:
+        job_ids = [job_id.decode('utf-8') for job_id in self.redis.zrange(self.REDIS_JOB_INDEX, 0, -1)]
+
+        if not job_ids:
             return all_jobs
-        
+
         # Redisから一度にデータを取得
-        job_values = self.redis.mget(job_keys)
-        
-        for key, value in zip(job_keys, job_values):
+        job_values = self.redis.mget([f"{self.REDIS_JOB_PREFIX}{job_id}:meta" for job_id in job_ids])
+
+        for job_id, value in zip(job_ids, job_values):
             if value:
-                job_key_str = key.decode('utf-8')
-                job_id = job_key_str.replace(self.REDIS_JOB_PREFIX, "").replace(":meta", "")
-                job_data = json.loads(value.decode('utf-8'))
-                all_jobs[job_id] = job_data
-        
+                all_jobs[job_id] = json.loads(value.decode('utf-8'))
+
         return all_jobs
 
+    def record_timings(self, job_id, timings):
+        """
+        処理段階ごとの所要時間（秒）をジョブに記録し、段階ごとの直近の値にも追加する。
+
+        Args:
+            job_id (str): ジョブID。
+            timings (dict): 段階名 -> 秒数（TIMING_STAGESのいずれか）。
+        """
+        if not timings:
+            return
+        timings_key = f"{self.REDIS_JOB_PREFIX}{job_id}:timings"
+        pipeline = self.redis.pipeline()
+        pipeline.hset(timings_key, mapping=timings)
+        pipeline.expire(timings_key, self.RESULT_TTL)
+        for stage, seconds in timings.items():
+            pipeline.lpush(f"{self.TIMING_PREFIX}{stage}", seconds)
+            pipeline.ltrim(f"{self.TIMING_PREFIX}{stage}", 0, self.TIMING_SAMPLES - 1)
+            observe_histogram(pipeline, "spice_job_stage_seconds", {"stage": stage}, seconds)
+        pipeline.execute()
+
+    def record_task_duration(self, task_name, status, seconds):
+        """Celeryタスクの所要時間をメトリクスに記録"""
+        pipeline = self.redis.pipeline()
+        observe_histogram(pipeline, "spice_celery_task_seconds", {"task": task_name, "status": status}, seconds)
+        pipeline.execute()
+
+    def get_metrics_writer(self):
+        """キュー・ジョブ・結果のメトリクスを追加したPrometheus形式の出力を作成"""
+        self.sweep_expired_cached_results()
+        writer = MetricsWriter()
+        collect_redis_metrics(self.redis, writer)
+        return writer
+
+    def get_job_timings(self, job_id):
+        """ジョブの処理段階ごとの所要時間（秒）を取得"""
+        timings = self.redis.hgetall(f"{self.REDIS_JOB_PREFIX}{job_id}:timings")
+        return {stage.decode('utf-8'): float(seconds) for stage, seconds in timings.items()}
+
+    def get_timing_stats(self):
+        """処理段階ごとの直近の所要時間から件数・平均・パーセンタイルを計算"""
+        pipeline = self.redis.pipeline()
+        for stage in self.TIMING_STAGES:
+            pipeline.lrange(f"{self.TIMING_PREFIX}{stage}", 0, -1)
+
+        stats = {}
+        for stage, samples in zip(self.TIMING_STAGES, pipeline.execute()):
+            if not samples:
+                continue
+            values = sorted(float(sample) for sample in samples)
+            stats[stage] = {
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                "p50": self._percentile(values, 50),
+                "p90": self._percentile(values, 90),
+                "p99": self._percentile(values, 99),
+                "max": values[-1],
+            }
+        return stats
+
+    @staticmethod
+    def _percentile(sorted_values, percent):
+        """ソート済みの値のパーセンタイル（最近傍順位法）"""
+        rank = max(int(-(-percent * len(sorted_values) // 100)) - 1, 0)
+        return sorted_values[rank]
+
+    def get_last_job_event_id(self):
+        """Streamの最新のイベントIDを取得（イベントがなければ"0-0"）"""
+        latest = self.redis.xrevrange(self.JOB_EVENTS, count=1)
+        return latest[0][0].decode('utf-8') if latest else "0-0"
+
+    def has_job_events_since(self, last_id):
+        """last_idより後のイベントがStreamに全て残っているか（古いイベントは上限を超えると削除される）"""
+        oldest = self.redis.xrange(self.JOB_EVENTS, count=1)
+        if not oldest:
+            return True
+        try:
+            last = tuple(int(part) for part in last_id.split("-"))
+        except ValueError:
+            return False
+        return last >= tuple(int(part) for part in oldest[0][0].decode('utf-8').split("-"))
+
+    def read_job_events(self, last_id, block_ms=15000):
+        """
+        last_idより後のジョブの状態遷移を取得（なければblock_msミリ秒まで待つ）。
+
+        Returns:
+            list: (イベントID, {"job_id", "status", ["error"]}) のリスト。タイムアウト時は空。
+        """
+        response = self.redis.xread({self.JOB_EVENTS: last_id}, block=block_ms)
+        events = []
+        for _, entries in response or []:
+            for event_id, fields in entries:
+                events.append((
+                    event_id.decode('utf-8'),
+                    {key.decode('utf-8'): value.decode('utf-8') for key, value in fields.items()},
+                ))
+        return events
+
+    def get_worker_slots(self):
+        """シミュレーションワーカーのスロットごとの状態を取得"""
+        workers = {}
+        for worker_id in self.redis.smembers("workers"):
+            worker_id = worker_id.decode('utf-8')
+            slots = self.redis.hgetall(f"worker:{worker_id}:slots")
+            if not slots:
+                # 状態の更新が止まったワーカーは登録を解除
+                self.redis.srem("workers", worker_id)
+                continue
+            workers[worker_id] = {
+                slot.decode('utf-8'): json.loads(value.decode('utf-8'))
+                for slot, value in slots.items()
+            }
+        return workers
+
     def clear_all_jobs(self):
         """Redisからすべてのジョブを削除"""
-        all_jobs = self.redis.keys(f"{self.REDIS_JOB_PREFIX}*:meta")
-        if all_jobs:
-            for job_key in all_jobs:
-                job_key_str = job_key.decode('utf-8')
-                self.redis.delete(job_key_str)  # メタデータ削除
-                self.redis.delete(job_key_str.replace(":meta", ":file"))  # ファイルデータ削除
+        job_ids = self.redis.zrange(self.REDIS_JOB_INDEX, 0, -1)
+        pipeline = self.redis.pipeline()
+        for job_id in job_ids:
+            job_id = job_id.decode('utf-8')
+            pipeline.delete(f"{self.REDIS_JOB_PREFIX}{job_id}:meta")  # メタデータ削除
+            pipeline.delete(f"{self.REDIS_JOB_PREFIX}{job_id}:file")  # ファイルデータ削除
+            pipeline.delete(f"{self.REDIS_RESULT_PREFIX}{job_id}")  # 結果データ削除
+            pipeline.delete(f"{self.REDIS_JOB_PREFIX}{job_id}:timings")  # 所要時間削除
+        pipeline.delete(self.REDIS_JOB_INDEX, self.FINISHED_JOBS)
+        pipeline.delete(self.RESULT_INDEX, self.RESULT_SIZES, self.RESULT_BYTES, self.RESULT_REFS)
+        publish_job_event(pipeline, "", "cleared")
+        pipeline.execute()
         return "Redisのジョブをすべて削除しました。"
@@ -248,7 +248,7 @@ if __name__ == "__main__":
             raw_file, log_file = simulate(jfet_iv, local=False)
 
             jfet_iv.load_results(raw_file, log_file)
-            image_path_iv = jfet_iv.plot()
+            image_path_iv = jfet_iv.save_image(jfet_iv.plot())
 
 
             # # JFETのVgs-Id特性をプロット
@@ -258,7 +258,7 @@ if __name__ == "__main__":
             # raw_file, log_file = simulate(jfet_vgs_id, local=False)
 
             # jfet_vgs_id.load_results(raw_file, log_file)
-            # image_path_vgs_id = jfet_vgs_id.plot()
+            # image_path_vgs_id = jfet_vgs_id.save_image(jfet_vgs_id.plot())
 
 
             # # JFETのgm-Vgs特性をプロット
@@ -268,7 +268,7 @@ if __name__ == "__main__":
             # raw_file, log_file = simulate(jfet_gm_vgs, local=False)
 
             # jfet_gm_vgs.load_results(raw_file, log_file)
-            # image_path_gm_vgs = jfet_gm_vgs.plot()
+            # image_path_gm_vgs = jfet_gm_vgs.save_image(jfet_gm_vgs.plot())
 
 
             # # JFETのgm-Id特性をプロット
@@ -278,7 +278,7 @@ if __name__ == "__main__":
             # raw_file, log_file = simulate(jfet_gm_id, local=False)
 
             # jfet_gm_id.load_results(raw_file, log_file)
-            # image_path_gm_id = jfet_gm_id.plot()
+            # image_path_gm_id = jfet_gm_id.save_image(jfet_gm_id.plot())
 
             upload_image(model_id, image_path_iv, 'iv')
             # upload_image(model_id, image_path_vgs_id, 'vgs_id')
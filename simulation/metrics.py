@@ -0,0 +1,219 @@
+# Prometheus形式（テキスト）のメトリクス
+# 複数のプロセス（Webアプリ、Celery、ワーカーのスロット）から記録するため、値はRedisに集約する
+# WebアプリとワーカーのどちらのイメージにもコピーされるのでRedisのキー名と結果の管理もここに置く
+import os
+import json
+import time
+
+# ヒストグラムのバケット（秒）
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+METRICS_PREFIX = "metrics:"
+HISTOGRAM_INDEX = "metrics:histograms"  # 記録されたヒストグラムのキー (SET)
+JOBS_TOTAL = "metrics:jobs_total"  # 終了したジョブの数 (HASH: ステータス -> 件数)
+JOBS_COALESCED = "metrics:jobs_coalesced"  # 実行中の同じジョブに相乗りした数 (HASH: 優先度 -> 件数)
+
+# ヒストグラムの名前と説明
+HISTOGRAMS = {
+    "spice_job_stage_seconds": "Duration of each stage of the simulation pipeline.",
+    "spice_celery_task_seconds": "Duration of Celery simulation tasks.",
+}
+
+# キュー・ジョブ・結果のキー名（JobModelとワーカーもここから読み込む）
+# 優先度ごとのキュー（先頭ほど優先度が高い）
+# ZSET: スコアは投入時刻 + 見積もり時間 x 重み（JobModel.get_queue_score）で、小さい順に取り出す
+JOB_QUEUES = {
+    "interactive": "job_lane:interactive",  # 画面操作からの即時シミュレーション
+    "batch": "job_lane:batch",              # Celeryからの一括シミュレーション
+    "bulk": "job_lane:bulk",                # 見積もりコストの大きいジョブ（他のキューが空のときだけ実行）
+}
+JOB_DOORBELL = "job_lane:doorbell"  # ジョブの投入時に積まれるLIST（待機中のワーカーを起こす）
+PROCESSING_JOBS = "processing_jobs"  # ワーカーが取り出して処理中のジョブ (LIST)
+FINISHED_JOBS = "job_finished_index"  # 終了したジョブID -> 終了時刻 (ZSET、古いものから削除する)
+INFLIGHT_PREFIX = "inflight:"  # キャッシュキー -> 待機中・実行中のジョブID（同じ内容のジョブの相乗り）
+JOB_EVENTS = "job_events"  # ジョブの状態遷移 (STREAM、ジョブ一覧画面へのSSEで配信)
+JOB_EVENTS_MAXLEN = 1000
+
+# result:* キーの保持期間とメモリ予算（超えた分は最後に取得された時刻が古い順に削除）
+REDIS_RESULT_PREFIX = "result:"
+RESULT_TTL = int(os.environ.get("RESULT_TTL", 1800))
+RESULT_MAX_BYTES = int(os.environ.get("RESULT_MAX_BYTES", 256 * 1024 * 1024))
+RESULT_INDEX = "result_index"  # 結果キー -> 最終アクセス時刻 (ZSET)
+RESULT_SIZES = "result_sizes"  # 結果キー -> バイト数 (HASH)
+RESULT_BYTES = "result_bytes"  # 結果全体のバイト数
+RESULT_REFS = "result_refs"  # 結果キー -> 参照している終了したジョブの数 (HASH、相乗りしたジョブも含む)
+RESULT_CACHE_BYTES = "result_cache_bytes"  # キャッシュ全体のバイト数
+RESULT_EVICTION_STATS = "result_eviction_stats"  # 削除理由ごとの件数とバイト数 (HASH)
+RESULT_EVICTION_LOG = "result_eviction_log"  # 最近削除された結果 (LIST)
+RESULT_EVICTION_LOG_MAX = 100
+
+
+def publish_job_event(pipeline, job_id, status, error=None):
+    """ジョブの状態遷移をStreamに追加（パイプラインに追加するだけ）"""
+    event = {"job_id": job_id, "status": status}
+    if error:
+        event["error"] = error
+    pipeline.xadd(JOB_EVENTS, event, maxlen=JOB_EVENTS_MAXLEN, approximate=True)
+
+
+def record_eviction(pipeline, key, size, reason):
+    """削除した結果を統計と最近の削除履歴に記録（パイプラインに追加するだけ）"""
+    pipeline.hincrby(RESULT_EVICTION_STATS, f"{reason}:count", 1)
+    pipeline.hincrby(RESULT_EVICTION_STATS, f"{reason}:bytes", size)
+    pipeline.lpush(RESULT_EVICTION_LOG, json.dumps({
+        "result_key": key, "bytes": size, "reason": reason, "evicted_at": time.time(),
+    }))
+    pipeline.ltrim(RESULT_EVICTION_LOG, 0, RESULT_EVICTION_LOG_MAX - 1)
+
+
+def discard_result(redis, result_key, reason):
+    """結果を削除してサイズの集計から外し、削除理由ごとの統計に記録する"""
+    size = int(redis.hget(RESULT_SIZES, result_key) or 0)
+    pipeline = redis.pipeline()
+    pipeline.delete(result_key)
+    pipeline.zrem(RESULT_INDEX, result_key)
+    pipeline.hdel(RESULT_SIZES, result_key)
+    pipeline.decrby(RESULT_BYTES, size)
+    record_eviction(pipeline, result_key, size, reason)
+    pipeline.execute()
+
+
+def evict_results(redis, keep=None):
+    """結果全体のサイズが予算内に収まるまで最後に取得された時刻が古い順に削除（keepは残す）"""
+    while int(redis.get(RESULT_BYTES) or 0) > RESULT_MAX_BYTES:
+        oldest = redis.zpopmin(RESULT_INDEX)
+        if not oldest:
+            redis.set(RESULT_BYTES, 0)
+            break
+        result_key, last_access = oldest[0]
+        result_key = result_key.decode("utf-8")
+        if result_key == keep:
+            # 保存したばかりの結果しか残っていない場合は取得されるまで残す
+            redis.zadd(RESULT_INDEX, {result_key: last_access})
+            break
+        discard_result(redis, result_key, "lru")
+
+
+def sweep_expired_results(redis):
+    """TTLで消えた結果をインデックスとサイズの集計から外す"""
+    # 取得されるたびにTTLを延長しているので、最終アクセスからTTL以上経ったものは消えている
+    expired = redis.zrangebyscore(RESULT_INDEX, 0, time.time() - RESULT_TTL)
+    for result_key in expired:
+        result_key = result_key.decode("utf-8")
+        if not redis.exists(result_key):
+            discard_result(redis, result_key, "expired")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _histogram_key(name, labels):
+    label_part = ",".join(f"{key}={value}" for key, value in sorted(labels.items()))
+    return f"{METRICS_PREFIX}hist:{name}:{label_part}"
+
+
+def _parse_histogram_key(key):
+    name, _, label_part = key[len(f"{METRICS_PREFIX}hist:"):].partition(":")
+    labels = dict(pair.split("=", 1) for pair in label_part.split(",") if pair)
+    return name, labels
+
+
+def observe_histogram(pipeline, name, labels, value):
+    """ヒストグラムに値を1つ記録（パイプラインに追加するだけ）"""
+    key = _histogram_key(name, labels)
+    pipeline.sadd(HISTOGRAM_INDEX, key)
+    for bucket in HISTOGRAM_BUCKETS:
+        if value <= bucket:
+            pipeline.hincrby(key, str(bucket), 1)
+    pipeline.hincrby(key, "+Inf", 1)
+    pipeline.hincrbyfloat(key, "sum", value)
+
+
+def count_job(pipeline, status):
+    """終了したジョブの数を数える（パイプラインに追加するだけ）"""
+    pipeline.hincrby(JOBS_TOTAL, status, 1)
+
+
+def count_coalesced(pipeline, priority):
+    """実行中の同じジョブに相乗りした（LTspiceを実行せずに済んだ）数を数える"""
+    pipeline.hincrby(JOBS_COALESCED, priority, 1)
+
+
+class MetricsWriter:
+    """Prometheusのテキスト形式の出力を組み立てる"""
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, metric_type, help_text, samples):
+        """
+        メトリクスを1つ追加。
+
+        Args:
+            samples (list): (サフィックス, ラベルのdict, 値) のリスト。
+        """
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {metric_type}")
+        for suffix, labels, value in samples:
+            self.lines.append(f"{name}{suffix}{_format_labels(labels)} {value}")
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def collect_redis_metrics(redis, writer):
+    """Redisに集約されたキュー・ジョブ・結果のメトリクスを追加"""
+    pipeline = redis.pipeline()
+    for queue_key in JOB_QUEUES.values():
+        pipeline.zcard(queue_key)
+    pipeline.llen(PROCESSING_JOBS)
+    pipeline.hgetall(JOBS_TOTAL)
+    pipeline.hgetall(JOBS_COALESCED)
+    pipeline.get(RESULT_BYTES)
+    pipeline.get(RESULT_CACHE_BYTES)
+    pipeline.smembers(HISTOGRAM_INDEX)
+    *queue_depths, processing, jobs_total, jobs_coalesced, result_bytes, cache_bytes, histogram_keys = pipeline.execute()
+
+    writer.add("spice_job_queue_depth", "gauge", "Number of jobs waiting in each queue.", [
+        ("", {"queue": priority}, depth) for priority, depth in zip(JOB_QUEUES, queue_depths)
+    ])
+    writer.add("spice_processing_jobs", "gauge", "Number of jobs claimed by simulation workers.", [
+        ("", {}, processing),
+    ])
+    writer.add("spice_jobs_total", "counter", "Number of finished jobs by status.", [
+        ("", {"status": status.decode("utf-8")}, int(count)) for status, count in sorted(jobs_total.items())
+    ])
+    writer.add("spice_jobs_coalesced_total", "counter", "Duplicate jobs attached to an identical in-flight job.", [
+        ("", {"priority": priority.decode("utf-8")}, int(count)) for priority, count in sorted(jobs_coalesced.items())
+    ])
+    writer.add("spice_result_bytes", "gauge", "Bytes held by result keys in Redis.", [
+        ("", {"store": "result"}, int(result_bytes or 0)),
+        ("", {"store": "cache"}, int(cache_bytes or 0)),
+    ])
+
+    histogram_keys = sorted(key.decode("utf-8") for key in histogram_keys)
+    pipeline = redis.pipeline()
+    for key in histogram_keys:
+        pipeline.hgetall(key)
+    histograms = {}
+    for key, fields in zip(histogram_keys, pipeline.execute()):
+        name, labels = _parse_histogram_key(key)
+        histograms.setdefault(name, []).append((labels, {field.decode("utf-8"): value for field, value in fields.items()}))
+
+    for name, help_text in HISTOGRAMS.items():
+        samples = []
+        for labels, fields in histograms.get(name, []):
+            for bucket in HISTOGRAM_BUCKETS:
+                samples.append(("_bucket", {**labels, "le": str(bucket)}, int(fields.get(str(bucket), 0))))
+            samples.append(("_bucket", {**labels, "le": "+Inf"}, int(fields.get("+Inf", 0))))
+            samples.append(("_sum", labels, float(fields.get("sum", 0))))
+            samples.append(("_count", labels, int(fields.get("+Inf", 0))))
+        writer.add(name, "histogram", help_text, samples)
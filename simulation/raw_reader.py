@@ -0,0 +1,319 @@
+import re
+import json
+import struct
+
+import numpy as np
+
+# 抽出した波形をまとめたペイロードの識別子
+TRACE_PAYLOAD_MAGIC = b"SMMT"
+
+# .logの動作点情報 ("Id:         1.34e-02" の形式)
+_LOG_VALUE_PATTERN = re.compile(r"^\s*([A-Za-z]\w*):\s+([-+]?[\d.]+(?:e[-+]?\d+)?)\s*$", re.IGNORECASE | re.MULTILINE)
+
+
+class RawTrace:
+    """LTspiceの.rawファイルの1つの波形（dataにアクセスされたときに初めてデコードする）"""
+
+    def __init__(self, name, whattype, view, is_time_axis=False):
+        self.name = name
+        self.whattype = whattype
+        self._view = view  # バッファを参照するだけのNumPyビュー（コピーなし）
+        self._is_time_axis = is_time_axis
+        self._data = None
+
+    @property
+    def data(self):
+        """波形データ（float64またはcomplex128に変換して返す）"""
+        if self._data is None:
+            if np.iscomplexobj(self._view):
+                data = np.asarray(self._view, dtype=np.complex128)
+            else:
+                data = np.asarray(self._view, dtype=np.float64)
+            if self._is_time_axis:
+                # LTspiceは圧縮した点の時刻を負の値で記録する
+                data = np.abs(data)
+            self._data = data
+        return self._data
+
+    def __len__(self):
+        return len(self._view)
+
+
+class _TraceContainer:
+    """波形を名前で参照するための共通部分"""
+
+    def __init__(self):
+        self.raw_params = {}
+        self._traces = {}
+
+    def get_trace_names(self):
+        """波形名の一覧を返す"""
+        return [trace.name for trace in self._traces.values()]
+
+    def get_trace(self, name):
+        """波形を名前で取得（大文字小文字は区別しない）"""
+        try:
+            return self._traces[name.lower()]
+        except KeyError:
+            raise KeyError(f"Trace not found: {name}") from None
+
+    def __getitem__(self, name):
+        return self.get_trace(name)
+
+    def get_len(self):
+        """点数を返す"""
+        return int(self.raw_params.get("No. Points", "0"))
+
+
+class LazyRawRead(_TraceContainer):
+    """
+    LTspiceのバイナリ形式の.rawファイルを読み込むクラス。
+    ヘッダのみを解析し、各波形はバッファへのゼロコピーのビューとして保持する。
+    ファイルパスを渡した場合はメモリマップで、bytesを渡した場合はそのまま参照する。
+
+    Args:
+        source (str or bytes): .rawファイルのパス、またはその内容。
+    """
+
+    _HEADER_SEARCH_SIZE = 64 * 1024
+
+    def __init__(self, source):
+        super().__init__()
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self._buffer = source
+        else:
+            self._buffer = np.memmap(source, dtype=np.uint8, mode='r')
+
+        self._variables = []  # (名前, 種類)
+
+        data_offset = self._parse_header()
+        self._map_traces(data_offset)
+
+    def _find_header_end(self, marker):
+        """ヘッダの終わり（マーカーの位置）を先頭から範囲を広げながら探す"""
+        size = len(self._buffer)
+        search_size = self._HEADER_SEARCH_SIZE
+        while True:
+            head = bytes(self._buffer[:min(search_size, size)])
+            position = head.find(marker)
+            if position >= 0 or search_size >= size:
+                return position
+            search_size *= 2
+
+    def _parse_header(self):
+        """ヘッダを解析してデータ部の開始位置を返す"""
+        # LTspice XVIIはUTF-16LE、その他のシミュレータはASCIIでヘッダを書く
+        encoding = 'utf-16-le' if bytes(self._buffer[1:2]) == b'\x00' else 'latin-1'
+
+        marker = "Binary:\n".encode(encoding)
+        header_end = self._find_header_end(marker)
+        if header_end < 0:
+            if self._find_header_end("Values:\n".encode(encoding)) >= 0:
+                raise ValueError("ASCII形式の.rawファイルには対応していません")
+            raise ValueError(".rawファイルのヘッダが見つかりません")
+
+        header = bytes(self._buffer[:header_end]).decode(encoding)
+        in_variables = False
+        for line in header.splitlines():
+            if in_variables:
+                if line[:1] in ('\t', ' ') and line.strip():
+                    fields = line.split()
+                    self._variables.append((fields[1], fields[2]))
+                    continue
+                in_variables = False
+            if line.startswith("Variables:"):
+                in_variables = True
+                continue
+            key, _, value = line.partition(":")
+            if key:
+                self.raw_params[key.strip()] = value.strip()
+
+        return header_end + len(marker)
+
+    def _get_dtypes(self):
+        """各変数のデータ型を決定（PyLTSpiceのRawReadと同じ規則）"""
+        flags = self.raw_params.get("Flags", "").lower().split()
+        plotname = self.raw_params.get("Plotname", "").lower()
+
+        if 'complex' in flags or plotname == 'ac analysis':
+            numerical_type = np.dtype('<c16')
+        elif 'double' in flags or plotname in ('transfer function', 'noise spectral density'):
+            numerical_type = np.dtype('<f8')
+        else:
+            numerical_type = np.dtype('<f4')
+
+        # .opなどは横軸を持たない。横軸はfloat32の場合でもfloat64で記録される
+        has_axis = plotname not in ('operating point', 'transfer function')
+        dtypes = [numerical_type] * len(self._variables)
+        if has_axis and dtypes and numerical_type == np.dtype('<f4'):
+            dtypes[0] = np.dtype('<f8')
+        return dtypes, has_axis
+
+    def _map_traces(self, data_offset):
+        """データ部を各波形のビューに割り当てる"""
+        n_points = int(self.raw_params.get("No. Points", "0"))
+        flags = self.raw_params.get("Flags", "").lower().split()
+        dtypes, has_axis = self._get_dtypes()
+
+        data_size = n_points * sum(dtype.itemsize for dtype in dtypes)
+        if len(self._buffer) - data_offset < data_size:
+            raise ValueError(f".rawファイルのデータが途中で切れています（{n_points}点分の{data_size}バイトが必要）")
+
+        if 'fastaccess' in flags:
+            # 波形ごとに連続して記録されている
+            offset = data_offset
+            views = []
+            for dtype in dtypes:
+                views.append(np.frombuffer(self._buffer, dtype=dtype, count=n_points, offset=offset))
+                offset += dtype.itemsize * n_points
+        else:
+            # 1点ごとに全変数が並んでいるので構造化配列のフィールドとして参照する
+            record = np.dtype([(f"v{i}", dtype) for i, dtype in enumerate(dtypes)])
+            records = np.frombuffer(self._buffer, dtype=record, count=n_points, offset=data_offset)
+            views = [records[f"v{i}"] for i in range(len(dtypes))]
+
+        for i, ((name, whattype), view) in enumerate(zip(self._variables, views)):
+            is_time_axis = has_axis and i == 0 and name.lower() == 'time'
+            self._traces[name.lower()] = RawTrace(name, whattype, view, is_time_axis)
+
+
+class TracePayload(_TraceContainer):
+    """
+    ワーカーが.rawから必要な波形だけを抽出したペイロードを読み込むクラス。
+    LazyRawReadと同じく trace.data で波形を参照できる。
+
+    形式: "SMMT" + ヘッダ長(uint32 LE) + JSONヘッダ + 各波形の配列（リトルエンディアン）
+    """
+
+    def __init__(self, payload):
+        super().__init__()
+        if bytes(payload[:4]) != TRACE_PAYLOAD_MAGIC:
+            raise ValueError("波形ペイロードの形式が正しくありません")
+
+        (header_size,) = struct.unpack_from("<I", payload, 4)
+        data_offset = 8 + header_size
+        header = json.loads(bytes(payload[8:data_offset]).decode('utf-8'))
+
+        self.raw_params = header.get("raw_params", {})
+        self.op_values = header.get("op", {})
+        for trace in header["traces"]:
+            view = np.frombuffer(payload, dtype=np.dtype(trace["dtype"]), count=trace["count"],
+                                 offset=data_offset + trace["offset"])
+            self._traces[trace["name"].lower()] = RawTrace(trace["name"], trace["whattype"], view)
+
+
+class SweepResult:
+    """
+    ネストした.dc掃引（.dc 内側の電源 ... 外側の電源 ...）の結果を2次元配列として扱うクラス。
+    LTspiceは外側の掃引の点ごとに内側の掃引を記録するので、内側の掃引の折り返し位置から
+    点数を求めて O(N) で並べ替える（値の比較はしないので浮動小数点の誤差の影響を受けない）。
+
+    各配列の形は (内側の点数, 外側の点数) で、行が内側の掃引の1つの値に対応する
+    （例: .dc V1(Vgs) ... V2(Vds) ... なら result[name][i] がVgsのi番目の曲線）。
+
+    Args:
+        container: 波形を名前で参照できる結果（LazyRawReadまたはTracePayload）。
+        inner_trace (str): 内側の掃引の値を表す波形名。
+        trace_names (list): 2次元に並べ替える波形名のリスト。
+    """
+
+    def __init__(self, container, inner_trace, trace_names):
+        inner = container[inner_trace].data
+        inner_count = self._find_inner_count(inner)
+        if len(inner) % inner_count:
+            raise ValueError(f"掃引の点数 {len(inner)} が内側の掃引の点数 {inner_count} で割り切れません")
+        shape = (len(inner) // inner_count, inner_count)
+
+        self._arrays = {}
+        for name in dict.fromkeys([inner_trace, *trace_names]):
+            # (外側, 内側) に並べ替えてから転置する（コピーはしない）
+            self._arrays[name.lower()] = container[name].data.reshape(shape).T
+        self.inner_values = self._arrays[inner_trace.lower()][:, 0]
+
+    @staticmethod
+    def _find_inner_count(inner):
+        """内側の掃引が折り返す（進む向きが逆になる）位置から1回分の点数を求める"""
+        if len(inner) < 2:
+            return max(len(inner), 1)
+        steps = np.diff(inner)
+        direction = np.sign(steps[0])
+        if direction == 0:
+            # 内側の掃引が1点だけ（例: 開始値と終了値が同じ）なら最初の2点で値が変わらない
+            return 1
+        restarts = np.flatnonzero(steps * direction < 0)
+        if len(restarts) == 0:
+            return len(inner)
+        inner_count = int(restarts[0]) + 1
+        if not np.array_equal(restarts + 1, np.arange(1, len(restarts) + 1) * inner_count):
+            raise ValueError("内側の掃引の点数が一定ではありません")
+        return inner_count
+
+    @property
+    def shape(self):
+        """(内側の点数, 外側の点数)"""
+        return self.inner_values.shape + (next(iter(self._arrays.values())).shape[1],)
+
+    def __getitem__(self, name):
+        try:
+            return self._arrays[name.lower()]
+        except KeyError:
+            raise KeyError(f"Trace not found: {name}") from None
+
+    def curves(self, x_name, y_name):
+        """内側の掃引の値ごとに (値, xの配列, yの配列) を返す"""
+        return zip(self.inner_values, self[x_name], self[y_name])
+
+
+def encode_trace_payload(raw, trace_names, dtype="float64", op_values=None):
+    """
+    .rawから指定した波形だけを取り出し、コンパクトなバイナリのペイロードにまとめる。
+
+    Args:
+        raw (LazyRawRead): 読み込んだ.rawファイル。
+        trace_names (list): 取り出す波形名のリスト。
+        dtype (str): 実数波形の保存形式 ("float64" または "float32")。
+        op_values (dict): .logから取り出した動作点の値。
+    """
+    real_dtype = np.dtype(dtype).newbyteorder('<')
+    complex_dtype = np.dtype('<c8' if real_dtype.itemsize == 4 else '<c16')
+
+    header = {
+        "version": 1,
+        "raw_params": {key: raw.raw_params[key] for key in ("Plotname", "Flags", "No. Points") if key in raw.raw_params},
+        "op": op_values or {},
+        "traces": [],
+    }
+    chunks = []
+    offset = 0
+    for name in trace_names:
+        trace = raw[name]
+        data = trace.data
+        array = np.ascontiguousarray(data, dtype=complex_dtype if np.iscomplexobj(data) else real_dtype)
+        header["traces"].append({
+            "name": trace.name,
+            "whattype": trace.whattype,
+            "dtype": array.dtype.str,
+            "offset": offset,
+            "count": len(array),
+        })
+        chunks.append(array.tobytes())
+        offset += array.nbytes
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    # 配列の先頭を8バイト境界に揃える
+    header_bytes += b" " * (-(8 + len(header_bytes)) % 8)
+    return TRACE_PAYLOAD_MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes + b"".join(chunks)
+
+
+def decode_log(log_data):
+    """.logの内容を文字列に変換（LTspiceのログはUTF-16LEで書かれている場合がある）"""
+    encoding = 'utf-16-le' if log_data[1:2] == b'\x00' else 'utf-8'
+    return log_data.decode(encoding, errors='replace')
+
+
+def parse_log_values(log_text):
+    """.logから "名前: 数値" 形式の動作点の値を取り出す（同名の場合は最初の値）"""
+    values = {}
+    for name, value in _LOG_VALUE_PATTERN.findall(log_text):
+        values.setdefault(name.lower(), float(value))
+    return values
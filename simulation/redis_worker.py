@@ -1,12 +1,32 @@
 import time
 import os
+import re
 import json
+import shutil
+import hashlib
+import socket
+import subprocess
+import threading
+import multiprocessing
 from redis import Redis
+from celery import Celery
 from datetime import datetime
 from io import BytesIO
 import zipfile
 from PyLTSpice import SimRunner, LTspice, SpiceEditor
 
+from raw_reader import LazyRawRead, encode_trace_payload, decode_log, parse_log_values
+from metrics import (
+    observe_histogram, count_job, publish_job_event, evict_results, sweep_expired_results,
+    JOB_QUEUES, JOB_DOORBELL, PROCESSING_JOBS, FINISHED_JOBS, INFLIGHT_PREFIX,
+    REDIS_RESULT_PREFIX, RESULT_TTL, RESULT_INDEX, RESULT_SIZES, RESULT_BYTES, RESULT_REFS,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SIMULATION_DIR = os.path.join(BASE_DIR, "data")
 os.makedirs(SIMULATION_DIR, exist_ok=True)
@@ -18,11 +38,105 @@ REDIS_DB = int(os.environ.get("REDISDB", 0))           # デフォルトはDB 0
 
 redis = Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
 REDIS_JOB_PREFIX = "job:"
-REDIS_RESULT_PREFIX = "result:"
+JOB_DONE_TTL = 300  # 完了通知リストの保持秒数
+
+# ジョブの完了時に続きの処理（on_complete）を投入するCeleryのブローカー
+CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", f"redis://{REDIS_HOST}:{REDIS_PORT}/1")
+celery = Celery(broker=CELERY_BROKER_URL)
+
+# 結果キャッシュのキーに含めるシミュレータのバージョン（LTspiceを更新したら変更する）
+SIMULATOR_VERSION = os.environ.get("SIMULATOR_VERSION", "LTspiceXVII")
+
+# 1ノードで同時に実行するシミュレーションの数（スロット数）
+WORKER_SLOTS = int(os.environ.get("WORKER_SLOTS", os.cpu_count() or 1))
+WORKER_ID = os.environ.get("WORKER_ID", socket.gethostname())
+SLOT_STATUS_TTL = 60  # スロット状態の保持秒数（更新が止まったノードは自然に消える）
+SUPERVISOR_INTERVAL = 5  # スロットの死活監視とリース切れジョブの回収の間隔（秒）
+
+# 信頼性のあるキュー: 取り出したジョブはリースが切れるとキューに戻される
+JOB_LEASE_TTL = int(os.environ.get("JOB_LEASE_TTL", 30))  # リースの有効期間（秒）
+MAX_JOB_RETRIES = int(os.environ.get("MAX_JOB_RETRIES", 3))  # 再実行の上限回数
+DEAD_LETTER_MAX = 1000  # デッドレターリストに残すジョブ数
+
+# result_format="files" の結果ファイルの圧縮方式
+RESULT_CODEC = "zstd" if zstandard else "none"
+RESULT_ZSTD_LEVEL = 3
+
+# Wine上のLTspiceの起動コストを減らすため、wineserverを常駐させてジョブ間で使い回す
+WINE_PERSISTENT = os.environ.get("WINE_PERSISTENT", "1") == "1"
+WINE_HEALTH_INTERVAL = int(os.environ.get("WINE_HEALTH_INTERVAL", 60))  # ヘルスチェックの間隔（秒）
+WINE_HEALTH_TIMEOUT = int(os.environ.get("WINE_HEALTH_TIMEOUT", 20))  # 応答がなければ固まったとみなす（秒）
+WINE_MAX_FAILURES = int(os.environ.get("WINE_MAX_FAILURES", 3))  # 連続して応答がなければ再起動する回数
+# wineserverを再起動した時刻（その前から実行していたジョブは失敗扱いにせずキューに戻す）
+WINE_RESTARTED_AT = f"worker:{WORKER_ID}:wine_restarted_at"
+os.environ.setdefault("WINEDEBUG", "-all")  # Wineのデバッグ出力を止めて起動を軽くする
+
+# LTspiceのログに記録される実際の計算時間
+_ELAPSED_TIME_PATTERN = re.compile(r"Total elapsed time:\s*([\d.]+)\s*seconds", re.IGNORECASE)
+
+# ウォームアップ用の最小の回路
+WARMUP_NETLIST = """* warmup
+V1 N001 0 1
+R1 N001 0 1k
+.op
+.end
+"""
+
+# 同じ内容のジョブの相乗り（JobModel.submit_jobがINFLIGHT_PREFIXのキーに登録する）
+# 実行中のジョブの登録を外し、相乗りしているジョブの一覧を取り出す（相乗りの登録と競合しないようアトミックに行う）
+FINISH_INFLIGHT_SCRIPT = redis.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+local followers = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+return followers
+""")
+
+# 処理段階ごとの所要時間（ジョブごとのハッシュと、段階ごとに直近の値を残すリスト）
+TIMING_PREFIX = "timings:"
+TIMING_SAMPLES = 1000
+
+# 優先度ごとのキュー（JOB_QUEUES）と JOB_DOORBELL は metrics で定義（空のときは JOB_DOORBELL をブロックして待つ）
+QUEUE_POLL_INTERVAL = 1  # 全キューが空のときに確認し直す間隔（秒）
 
-def run_simulation(uploaded_file_path):
+# 優先度の高いキューから順に、スコアの最も小さいジョブを処理中リストへ移動する
+# KEYS: 処理中リスト, キュー（優先度の高い順）
+CLAIM_JOB_SCRIPT = redis.register_script("""
+for i = 2, #KEYS do
+    local job = redis.call('ZPOPMIN', KEYS[i])
+    if job[1] then
+        redis.call('RPUSH', KEYS[1], job[1])
+        return job[1]
+    end
+end
+return false
+""")
+
+def get_slot_dir(slot):
+    """スロット専用の作業ディレクトリを取得"""
+    slot_dir = os.path.join(SIMULATION_DIR, f"slot_{slot}")
+    os.makedirs(slot_dir, exist_ok=True)
+    return slot_dir
+
+def report_slot_status(slot, status, job_id=None):
+    """スロットの状態をRedisに報告"""
+    slots_key = f"worker:{WORKER_ID}:slots"
+    slot_data = {
+        "status": status,
+        "job_id": job_id,
+        "pid": os.getpid(),
+        "updated_at": time.time(),
+    }
+    pipeline = redis.pipeline()
+    pipeline.hset(slots_key, slot, json.dumps(slot_data))
+    pipeline.expire(slots_key, SLOT_STATUS_TTL)
+    pipeline.sadd("workers", WORKER_ID)
+    pipeline.execute()
+
+def run_simulation(uploaded_file_path, output_dir=SIMULATION_DIR):
     """シミュレーションを実行してRAWデータとログを取得"""
-    runner = SimRunner(output_folder=SIMULATION_DIR, simulator=LTspice)
+    runner = SimRunner(output_folder=output_dir, simulator=LTspice)
     if uploaded_file_path.endswith('.asc'):
         netlist_path = runner.create_netlist(uploaded_file_path)
     else:
@@ -31,6 +145,99 @@ def run_simulation(uploaded_file_path):
     raw_path, log_path = runner.run_now(net, run_filename=netlist_path)
     return raw_path, log_path, netlist_path
 
+def get_simulator_elapsed(log_path):
+    """LTspiceのログから実際の計算時間（秒）を取得（記録がなければNone）"""
+    try:
+        with open(log_path, "rb") as f:
+            match = _ELAPSED_TIME_PATTERN.search(decode_log(f.read()))
+    except OSError:
+        return None
+    return float(match.group(1)) if match else None
+
+class WineEnvironment:
+    """
+    常駐させたwineserverとウォームアップ済みのLTspiceの環境。
+    全スロットが同じWINEPREFIXを使うので、wineserverはスーパーバイザーが1つだけ管理する。
+    """
+
+    def __init__(self):
+        self.enabled = WINE_PERSISTENT and shutil.which("wineserver") is not None
+        self.restarts = 0
+        self.failures = 0  # 連続して応答がなかった回数
+        self.last_check = 0
+
+    def start(self):
+        """wineserverを常駐モードで起動し、LTspiceを1回実行してウォームアップする"""
+        if not self.enabled:
+            return
+        # -p: クライアントがいなくなっても終了しない
+        subprocess.run(["wineserver", "-p"], check=False, timeout=WINE_HEALTH_TIMEOUT)
+        start_time = time.perf_counter()
+        try:
+            self.warm_up()
+            print(f"Wine environment warmed up in {time.perf_counter() - start_time:.2f} seconds.")
+        except Exception as e:
+            print(f"Wine warm-up failed: {e}")
+        self.last_check = time.time()
+
+    def warm_up(self):
+        """小さな.opの回路を実行してLTspiceとDLLを読み込ませておく"""
+        warmup_dir = os.path.join(SIMULATION_DIR, "warmup")
+        os.makedirs(warmup_dir, exist_ok=True)
+        netlist_path = os.path.join(warmup_dir, "warmup.net")
+        with open(netlist_path, "w") as f:
+            f.write(WARMUP_NETLIST)
+        raw_path, log_path, _ = run_simulation(netlist_path, warmup_dir)
+        cleanup_files([raw_path, log_path])
+
+    def stop(self):
+        if self.enabled:
+            subprocess.run(["wineserver", "-k"], check=False, timeout=WINE_HEALTH_TIMEOUT)
+
+    def is_healthy(self):
+        """wineserverが応答するか確認（固まっている場合はタイムアウトする）"""
+        try:
+            result = subprocess.run(["wine", "cmd", "/c", "exit"], timeout=WINE_HEALTH_TIMEOUT,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (subprocess.TimeoutExpired, OSError):
+            return False
+        return result.returncode == 0
+
+    def check(self):
+        """
+        一定間隔でヘルスチェックを行い、WINE_MAX_FAILURES回続けて応答しなければ再起動する。
+        再起動で中断されたジョブはrun_jobがキューに戻す。
+        """
+        if not self.enabled:
+            return
+        # 応答がなかった後は間隔を空けずに確認し直す
+        if self.failures == 0 and time.time() - self.last_check < WINE_HEALTH_INTERVAL:
+            return
+        self.last_check = time.time()
+        if self.is_healthy():
+            self.failures = 0
+            return
+
+        self.failures += 1
+        if self.failures < WINE_MAX_FAILURES:
+            print(f"Wine environment is not responding ({self.failures}/{WINE_MAX_FAILURES}).")
+            return
+
+        print("Wine environment is not responding, restarting.")
+        self.failures = 0
+        self.restarts += 1
+        pipeline = redis.pipeline()
+        pipeline.set(WINE_RESTARTED_AT, time.time())
+        pipeline.hincrby("metrics:wine_restarts", WORKER_ID, 1)
+        pipeline.execute()
+        self.stop()
+        self.start()
+
+def wine_restarted_since(started_at):
+    """started_at以降にwineserverが再起動されたか"""
+    restarted_at = redis.get(WINE_RESTARTED_AT)
+    return restarted_at is not None and float(restarted_at) >= started_at
+
 def cleanup_files(files):
     """一時ファイル削除"""
     for file in files:
@@ -41,11 +248,23 @@ def cleanup_files(files):
             print(f"Failed to delete file {file}: {e}")
 
 def update_job(job_id, **kwargs):
-    """ジョブ情報を更新"""
+    """ジョブ情報を更新（状態が変わった場合はジョブのイベントStreamにも追加）"""
     job_key = f"{REDIS_JOB_PREFIX}{job_id}:meta"
     job_data = json.loads(redis.get(job_key))
+    was_finished = job_data.get("status") in ("completed", "failed")
     job_data.update(kwargs)
-    redis.set(job_key, json.dumps(job_data))
+    pipeline = redis.pipeline()
+    pipeline.set(job_key, json.dumps(job_data))
+    if kwargs.get("status") in ("completed", "failed") and not was_finished:
+        # 終了したジョブは終了が古い順に削除される（JobModel.trim_jobs）
+        pipeline.zadd(FINISHED_JOBS, {job_id: time.time()})
+        result_key = job_data.get("result_key")
+        if kwargs["status"] == "completed" and result_key and result_key.startswith(REDIS_RESULT_PREFIX):
+            # 相乗りしたジョブも同じ結果を参照するので、最後のジョブが削除されるまで結果を残す
+            pipeline.hincrby(RESULT_REFS, result_key, 1)
+    if "status" in kwargs:
+        publish_job_event(pipeline, job_id, kwargs["status"], kwargs.get("error"))
+    pipeline.execute()
 
 def get_job_meta(job_id):
     """ジョブのメタデータを取得"""
@@ -58,8 +277,172 @@ def get_job_file(job_id):
     file_key = f"{REDIS_JOB_PREFIX}{job_id}:file"
     return redis.get(file_key)
 
-def run_job(job_id):
+def record_timings(job_id, timings):
+    """処理段階ごとの所要時間（秒）をジョブに記録し、段階ごとの直近の値にも追加"""
+    timings_key = f"{REDIS_JOB_PREFIX}{job_id}:timings"
+    pipeline = redis.pipeline()
+    pipeline.hset(timings_key, mapping=timings)
+    pipeline.expire(timings_key, RESULT_TTL)
+    for stage, seconds in timings.items():
+        pipeline.lpush(f"{TIMING_PREFIX}{stage}", seconds)
+        pipeline.ltrim(f"{TIMING_PREFIX}{stage}", 0, TIMING_SAMPLES - 1)
+        observe_histogram(pipeline, "spice_job_stage_seconds", {"stage": stage}, seconds)
+    pipeline.execute()
+
+def notify_job_done(job_id, status, count=True):
+    """ジョブ専用の完了通知リストに完了を通知（countがTrueならメトリクスにも数える）"""
+    done_key = f"{REDIS_JOB_PREFIX}{job_id}:done"
+    pipeline = redis.pipeline()
+    # 待機中のクライアントはこのリストをBLPOPしている
+    pipeline.rpush(done_key, status)
+    pipeline.expire(done_key, JOB_DONE_TTL)
+    if count:
+        count_job(pipeline, status)
+    pipeline.execute()
+
+def dispatch_continuation(job_id, job_data, status):
+    """ジョブに続きの処理（on_complete）が登録されていれば、Celeryタスクとして投入する"""
+    on_complete = job_data.get("on_complete")
+    if not on_complete:
+        return
+    try:
+        celery.send_task(on_complete["task"],
+                         kwargs={**on_complete.get("kwargs", {}), "job_id": job_id, "status": status})
+    except Exception as e:
+        print(f"Failed to dispatch {on_complete.get('task')} for job {job_id}: {e}")
+        update_job(job_id, continuation_error=str(e))
+
+def finish_job(job_id, status):
+    """ジョブの完了を通知し、相乗りしているジョブも同じ結果で完了させる"""
+    notify_job_done(job_id, status)
+
+    job_data = get_job_meta(job_id) or {}
+    dispatch_continuation(job_id, job_data, status)
+    cache_key = job_data.get("cache_key")
+    if not cache_key:
+        return
+    followers = FINISH_INFLIGHT_SCRIPT(
+        keys=[f"{INFLIGHT_PREFIX}{cache_key}", f"{REDIS_JOB_PREFIX}{job_id}:followers"],
+        args=[job_id],
+    )
+    for follower_id in followers:
+        follower_id = follower_id.decode("utf-8")
+        if not get_job_meta(follower_id):
+            continue  # 古いジョブとして削除済み
+        if status == "completed":
+            update_job(follower_id, status=status, result_key=job_data.get("result_key"))
+        else:
+            update_job(follower_id, status=status, error=job_data.get("error"))
+        notify_job_done(follower_id, status, count=False)
+        dispatch_continuation(follower_id, get_job_meta(follower_id) or {}, status)
+    if followers:
+        print(f"Job {job_id} also {status} {len(followers)} attached job(s).")
+
+def run_bundle(bundle_data, scratch_dir):
+    """バンドル(ZIP)内の複数のネットリストを実行し、結果ファイルの一覧を返す"""
+    artifacts = []  # (結果での名前, ファイルパス)
+    temp_files = []
+    results = {}  # ネットリストのハッシュ -> (rawファイル, logファイル)
+
+    with zipfile.ZipFile(BytesIO(bundle_data)) as bundle:
+        for member in bundle.namelist():
+            member_name = os.path.basename(member)
+            stem = os.path.splitext(member_name)[0]
+            netlist_data = bundle.read(member)
+
+            netlist_path = os.path.join(scratch_dir, member_name)
+            with open(netlist_path, "wb") as f:
+                f.write(netlist_data)
+            temp_files.append(netlist_path)
+
+            # 内容が同じネットリストは1回だけ実行する
+            digest = hashlib.sha256(netlist_data).hexdigest()
+            if digest not in results:
+                raw_file_path, log_file_path, _ = run_simulation(netlist_path, scratch_dir)
+                results[digest] = (raw_file_path, log_file_path)
+                temp_files += [raw_file_path, log_file_path]
+
+            # 結果はメンバー名ごとに格納する
+            raw_file_path, log_file_path = results[digest]
+            artifacts += [
+                (f"{stem}.raw", raw_file_path),
+                (f"{stem}.log", log_file_path),
+                (member_name, netlist_path),
+            ]
+
+    return artifacts, temp_files
+
+def read_artifact(content):
+    """結果ファイルの内容を取得（ファイルパスまたはバイナリデータ）"""
+    if isinstance(content, bytes):
+        return content
+    with open(content, "rb") as f:
+        return f.read()
+
+def extract_trace_artifacts(artifacts, traces, dtype="float64"):
+    """
+    .rawの代わりに指定された波形だけを抜き出したペイロード(.traces)を結果に含める。
+    ペイロードには対応する.logから取り出した動作点の値も格納する。
+    """
+    logs = {os.path.splitext(name)[0]: content for name, content in artifacts if name.endswith(".log")}
+    extracted = []
+    for name, content in artifacts:
+        if not name.endswith(".raw"):
+            extracted.append((name, content))
+            continue
+
+        stem = os.path.splitext(name)[0]
+        op_values = {}
+        if stem in logs:
+            op_values = parse_log_values(decode_log(read_artifact(logs[stem])))
+        raw = LazyRawRead(content)
+        # バンドルでは全メンバー共通の指定になるため、存在しない波形は含めない
+        available = {name.lower() for name in raw.get_trace_names()}
+        trace_names = [trace for trace in traces if trace.lower() in available]
+        extracted.append((f"{stem}.traces", encode_trace_payload(raw, trace_names, dtype, op_values)))
+    return extracted
+
+def compress_artifact(data):
+    """結果ファイルを高速な圧縮方式で圧縮（zstandardが無ければ無圧縮）"""
+    if RESULT_CODEC == "zstd":
+        return zstandard.ZstdCompressor(level=RESULT_ZSTD_LEVEL).compress(data)
+    return data
+
+def store_result(result_key, artifacts, result_format):
+    """
+    結果ファイルをRedisに保存する。
+    zip: 全ファイルを1つのZIPにまとめて保存
+    files: ファイルごとにハッシュのフィールドとして保存（"__codec__"に圧縮方式を記録）
+    """
+    previous_size = redis.hget(RESULT_SIZES, result_key)
+    pipeline = redis.pipeline()
+    if result_format == "files":
+        mapping = {"__codec__": RESULT_CODEC}
+        for name, content in artifacts:
+            mapping[name] = compress_artifact(read_artifact(content))
+        size = sum(len(data) for data in mapping.values())
+        pipeline.delete(result_key)
+        pipeline.hset(result_key, mapping=mapping)
+        pipeline.expire(result_key, RESULT_TTL)
+    else:
+        zip_buffer = BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for name, content in artifacts:
+                zip_file.writestr(name, read_artifact(content))
+        size = zip_buffer.getbuffer().nbytes
+        pipeline.set(result_key, zip_buffer.getvalue(), ex=RESULT_TTL)
+
+    # メモリ予算の管理用にサイズと最終アクセス時刻を登録
+    pipeline.zadd(RESULT_INDEX, {result_key: time.time()})
+    pipeline.hset(RESULT_SIZES, result_key, size)
+    pipeline.incrby(RESULT_BYTES, size - int(previous_size or 0))
+    pipeline.execute()
+
+    evict_results(redis, keep=result_key)
+
+def run_job(job_id, scratch_dir=SIMULATION_DIR):
     """ジョブを実行"""
+    started_at = time.time()
     try:
         # メタデータを取得
         job_data = get_job_meta(job_id)
@@ -68,63 +451,198 @@ def run_job(job_id):
             return
 
         print(f"Processing job {job_id} - status: {job_data['status']}")
+        timings = {}
+        if "created_at" in job_data:
+            timings["queue_wait"] = time.time() - job_data["created_at"]
 
         # ファイルデータを取得して一時ファイルに保存
         binary_file = get_job_file(job_id)
         if not binary_file:
             print(f"Job {job_id} file data not found.")
             update_job(job_id, status="failed", error="File data missing.")
+            finish_job(job_id, "failed")
             return
 
-        filename = job_data["file_path"]
+        stage_start = time.perf_counter()
+        if job_data.get("kind") == "bundle":
+            # 複数のネットリストを1つのジョブとしてまとめて実行
+            artifacts, temp_files = run_bundle(binary_file, scratch_dir)
+        else:
+            filename = job_data["file_path"]
 
-        uploaded_file_path = os.path.join(SIMULATION_DIR, filename)
-        
-        with open(uploaded_file_path, "wb") as f:
-            f.write(binary_file)
+            uploaded_file_path = os.path.join(scratch_dir, filename)
 
-        # シミュレーションを実行
-        raw_file_path, log_file_path, netlist_path = run_simulation(uploaded_file_path)
+            with open(uploaded_file_path, "wb") as f:
+                f.write(binary_file)
 
-        # 結果をZIPにまとめる
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            zip_file.write(raw_file_path, os.path.basename(raw_file_path))
-            zip_file.write(log_file_path, os.path.basename(log_file_path))
-            zip_file.write(uploaded_file_path, os.path.basename(uploaded_file_path))
+            # シミュレーションを実行
+            raw_file_path, log_file_path, netlist_path = run_simulation(uploaded_file_path, scratch_dir)
+
+            artifacts = [
+                (os.path.basename(raw_file_path), raw_file_path),
+                (os.path.basename(log_file_path), log_file_path),
+                (os.path.basename(uploaded_file_path), uploaded_file_path),
+            ]
             if uploaded_file_path.endswith('.asc'):
-                zip_file.write(netlist_path, os.path.basename(netlist_path))
-        zip_buffer.seek(0)
+                artifacts.append((os.path.basename(netlist_path), netlist_path))
+            temp_files = [uploaded_file_path, raw_file_path, log_file_path]
+        timings["simulation"] = time.perf_counter() - stage_start
+
+        # Wineとシミュレータの起動・終了にかかった時間（実行時間 - LTspiceの計算時間）
+        # バンドルで同じ内容のネットリストは1回しか実行していないのでログのパスで重複を除く
+        log_paths = {path for name, path in artifacts if name.endswith(".log")}
+        elapsed = [get_simulator_elapsed(path) for path in log_paths]
+        if elapsed and None not in elapsed:
+            timings["launch_overhead"] = max(timings["simulation"] - sum(elapsed), 0)
+
+        # 必要な波形だけを返すよう指定されている場合は.rawから抜き出す
+        if job_data.get("traces") is not None:
+            stage_start = time.perf_counter()
+            artifacts = extract_trace_artifacts(artifacts, job_data["traces"], job_data.get("trace_dtype", "float64"))
+            timings["extract"] = time.perf_counter() - stage_start
 
         # 結果データを保存
+        stage_start = time.perf_counter()
         result_key = f"{REDIS_RESULT_PREFIX}{job_id}"
-        redis.set(result_key, zip_buffer.getvalue())
-
-        # Streamでジョブの完了通知を送信
-        redis.xadd("job_notifications", {"job_id": job_id}, maxlen=25)
+        store_result(result_key, artifacts, job_data.get("result_format", "zip"))
+        timings["store"] = time.perf_counter() - stage_start
+        record_timings(job_id, timings)
 
         # ジョブステータス更新
         update_job(job_id, status="completed", result_key=result_key)
 
+        # ジョブの完了通知を送信
+        finish_job(job_id, "completed")
+
         # 一時ファイルを削除
-        cleanup_files([uploaded_file_path, raw_file_path, log_file_path])
+        cleanup_files(temp_files)
 
         print(f"Job {job_id} completed successfully.")
 
     except Exception as e:
+        if wine_restarted_since(started_at):
+            # wineserverの再起動で中断されたので、呼び出し元（job_worker）でキューに戻す
+            raise
         print(f"Error processing job {job_id}: {e}")
         update_job(job_id, status="failed", error=str(e))
+        finish_job(job_id, "failed")
 
-def job_worker():
-    """ジョブをブロックして待機し、ジョブが来たら処理する (処理中リストを導入)"""
-    while True:
-        # BLPOPを使ってジョブをブロックして取得
-        job = redis.blpop("job_queue", timeout=0)
-        job_id = job[1].decode("utf-8")
-        print(f"Received job {job_id} from queue")
+def renew_lease(job_id):
+    """ジョブのリース期限を延長"""
+    redis.zadd("job_leases", {job_id: time.time() + JOB_LEASE_TTL})
+
+def release_job(job_id):
+    """処理中リストとリースからジョブを外す"""
+    pipeline = redis.pipeline()
+    pipeline.lrem(PROCESSING_JOBS, 0, job_id)
+    pipeline.zrem("job_leases", job_id)
+    pipeline.execute()
+
+def requeue_job(job_id, reason):
+    """処理中のジョブをキューに戻す（上限回数を超えたらデッドレターへ）"""
+    # LREMに成功したプロセスだけが再投入する（複数のreaperが同時に動いても重複しない）
+    if not redis.lrem(PROCESSING_JOBS, 0, job_id):
+        return
+    redis.zrem("job_leases", job_id)
+
+    job_data = get_job_meta(job_id)
+    if not job_data:
+        return
+
+    retries = job_data.get("retries", 0) + 1
+    if retries > MAX_JOB_RETRIES:
+        print(f"Job {job_id} moved to dead letter list: {reason}")
+        update_job(job_id, status="failed", error=f"Retry limit exceeded: {reason}", retries=retries)
+        pipeline = redis.pipeline()
+        pipeline.rpush("dead_letter_jobs", job_id)
+        pipeline.ltrim("dead_letter_jobs", -DEAD_LETTER_MAX, -1)
+        pipeline.execute()
+        finish_job(job_id, "failed")
+    else:
+        print(f"Requeueing job {job_id} (retry {retries}/{MAX_JOB_RETRIES}): {reason}")
+        update_job(job_id, status="pending", retries=retries)
+        queue_key = JOB_QUEUES.get(job_data.get("priority"), JOB_QUEUES["batch"])
+        pipeline = redis.pipeline()
+        pipeline.zadd(queue_key, {job_id: 0})  # 待たせないよう先頭に戻す
+        pipeline.rpush(JOB_DOORBELL, 1)
+        pipeline.execute()
+
+class JobReaper:
+    """リースの切れたジョブを回収してキューに戻す"""
+
+    def __init__(self):
+        # リースを取得する前に落ちたジョブは2回連続で見つかったときに回収する
+        self.orphan_candidates = set()
+
+    def reap(self):
+        expired = redis.zrangebyscore("job_leases", 0, time.time())
+        for job_id in expired:
+            job_id = job_id.decode("utf-8")
+            if redis.zrem("job_leases", job_id):
+                requeue_job(job_id, "lease expired")
+
+        processing = {job_id.decode("utf-8") for job_id in redis.lrange(PROCESSING_JOBS, 0, -1)}
+        leased = {job_id.decode("utf-8") for job_id in redis.zrange("job_leases", 0, -1)}
+        orphans = processing - leased
+        for job_id in orphans & self.orphan_candidates:
+            requeue_job(job_id, "no lease")
+        self.orphan_candidates = orphans - self.orphan_candidates
+
+class SlotHeartbeat:
+    """実行中ジョブのリースとスロットの状態を定期的に更新するスレッド"""
 
-        # 処理中ジョブリストに追加
-        redis.rpush("processing_jobs", job_id)
+    def __init__(self, slot):
+        self.slot = slot
+        self.job_id = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{slot}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(JOB_LEASE_TTL / 3):
+            try:
+                self.beat()
+            except Exception as e:
+                print(f"[slot {self.slot}] Heartbeat failed: {e}")
+
+    def beat(self):
+        job_id = self.job_id
+        if job_id:
+            renew_lease(job_id)
+            report_slot_status(self.slot, "running", job_id)
+        else:
+            report_slot_status(self.slot, "idle")
+
+def claim_job():
+    """優先度の高いキューから順に、見積もりの短いジョブを処理中リストへ移動して取得"""
+    job = CLAIM_JOB_SCRIPT(keys=[PROCESSING_JOBS, *JOB_QUEUES.values()])
+    if job:
+        return job
+
+    # どのキューも空ならジョブの投入を待つ（通知を取りこぼしても一定間隔で確認し直す）
+    redis.blpop(JOB_DOORBELL, timeout=QUEUE_POLL_INTERVAL)
+    return None
+
+def job_worker(slot=0):
+    """ジョブをブロックして待機し、ジョブが来たら処理する（アトミックに処理中リストへ移動）"""
+    scratch_dir = get_slot_dir(slot)
+    heartbeat = SlotHeartbeat(slot)
+    heartbeat.beat()
+    heartbeat.start()
+
+    while True:
+        # キューから処理中リストへアトミックに移動（ワーカーが落ちてもジョブは失われない）
+        job = claim_job()
+        if job is None:
+            continue
+        job_id = job.decode("utf-8")
+        renew_lease(job_id)
+        print(f"[slot {slot}] Received job {job_id} from queue")
 
         try:
             # ジョブのメタ情報を取得して、処理が可能か確認
@@ -132,26 +650,75 @@ def job_worker():
 
             # ジョブが存在しない場合や処理中の場合スキップ
             if not job_data or job_data["status"] != "pending":
-                print(f"Skipping job {job_id} as it is not pending.")
-                redis.lrem("processing_jobs", 0, job_id)  # 処理中リストから削除
+                print(f"[slot {slot}] Skipping job {job_id} as it is not pending.")
+                release_job(job_id)  # 処理中リストから削除
                 continue
 
             # ジョブを処理
-            print(f"Starting job {job_id}...")
+            print(f"[slot {slot}] Starting job {job_id}...")
+            heartbeat.job_id = job_id
+            heartbeat.beat()
+            update_job(job_id, status="running", worker=WORKER_ID, slot=slot)
             start_time = time.time()  # 処理開始時刻を記録
-            run_job(job_id)
+            run_job(job_id, scratch_dir)
             elapsed_time = time.time() - start_time  # 経過時間を計算
-            print(f"Job {job_id} completed in {elapsed_time:.2f} seconds.")
+            print(f"[slot {slot}] Job {job_id} completed in {elapsed_time:.2f} seconds.")
 
-            # 処理が成功した場合、処理中リストから削除
-            redis.lrem("processing_jobs", 0, job_id)
+            # 処理が終わった場合、処理中リストとリースから削除
+            release_job(job_id)
 
         except Exception as e:
             # エラーが発生した場合、ジョブを再度キューに戻す
-            print(f"Error processing job {job_id}: {e}")
-            redis.rpush("job_queue", job_id)
-            redis.lrem("processing_jobs", 0, job_id)
+            print(f"[slot {slot}] Error processing job {job_id}: {e}")
+            requeue_job(job_id, str(e))
+
+        finally:
+            heartbeat.job_id = None
+            heartbeat.beat()
+
+def start_slot(slot):
+    """スロットのワーカープロセスを起動"""
+    process = multiprocessing.Process(target=job_worker, args=(slot,), name=f"slot-{slot}", daemon=True)
+    process.start()
+    return process
+
+def supervise_workers(num_slots=WORKER_SLOTS):
+    """スロット数分のワーカープロセスを起動し、停止したものの再起動とリース切れジョブの回収を行う"""
+    # クライアント側の結果キャッシュが参照するバージョンを登録
+    redis.set("simulator_version", SIMULATOR_VERSION)
+    redis.delete(f"worker:{WORKER_ID}:slots")
+
+    # スロットを起動する前にwineserverを常駐させておく
+    wine = WineEnvironment()
+    wine.start()
+
+    print(f"Starting {num_slots} simulation slots on {WORKER_ID}")
+    processes = {slot: start_slot(slot) for slot in range(num_slots)}
+    reaper = JobReaper()
+
+    while True:
+        time.sleep(SUPERVISOR_INTERVAL)
+        for slot, process in processes.items():
+            if not process.is_alive():
+                print(f"Slot {slot} exited with code {process.exitcode}, restarting.")
+                report_slot_status(slot, "restarting")
+                processes[slot] = start_slot(slot)
+
+        try:
+            reaper.reap()
+        except Exception as e:
+            print(f"Failed to reap expired jobs: {e}")
+
+        try:
+            sweep_expired_results(redis)
+        except Exception as e:
+            print(f"Failed to sweep expired results: {e}")
+
+        try:
+            wine.check()
+        except Exception as e:
+            print(f"Wine health check failed: {e}")
 
 
 if __name__ == "__main__":
-    job_worker()
+    supervise_workers()
@@ -1,7 +1,11 @@
 import os
 import json
+import time
+import base64
+import threading
+import struct
 from io import BytesIO
-from flask import Flask, Blueprint, request, send_file, jsonify, render_template, redirect, url_for, flash
+from flask import Flask, Blueprint, Response, request, send_file, jsonify, render_template, redirect, url_for, flash, stream_with_context
 import pandas as pd
 
 # 自作モジュールのインポート
@@ -13,8 +17,7 @@ from models.db_model import (
     get_experiment_data
 )
 
-from simulation.job_model import JobModel
-from simulation.file_extractor import FileExtractor
+from simulation.job_model import JobModel, JobCostError
 from simulation.jfet import JFET_IV_Characteristic, JFET_Vgs_Id_Characteristic, JFET_Gm_Vgs_Characteristic, JFET_Gm_Id_Characteristic
 from client.spice_model_parser import SpiceModelParser
 from forms import AddModelForm
@@ -27,9 +30,6 @@ simu_views = Blueprint('simu_views', __name__)
 # Redisホストの設定
 redis_host = os.getenv("REDIS_HOST", "localhost")  # デフォルトはlocalhost
 
-# Zipファイル用
-file_extractor = FileExtractor()
-
 # JobModelのインスタンスを作成
 job_model = JobModel(redis_host=redis_host)
 
@@ -50,16 +50,97 @@ def request_entity_too_large(error):
     return jsonify({"error": "File size exceeds the 1MB limit"}), 413
 
 
-@simu_views.route("/api/simulations", methods=["GET"])
-def get_simulations_api():
+# ジョブの状態遷移のSSE配信（1接続の最大時間を過ぎたらブラウザに再接続させる）
+JOB_EVENTS_BLOCK_MS = 15000
+JOB_EVENTS_MAX_DURATION = 60
+JOB_EVENTS_RETRY_MS = 2000
+# 接続を保持するSSEの数の上限（プロセスごと）。gthreadのスレッドを他のリクエストのために残しておく。
+# 上限を超えた接続は現在の状態だけを送ってすぐに閉じ、ブラウザはJOB_EVENTS_BUSY_RETRY_MS後に再接続する（ポーリングになる）
+JOB_EVENTS_MAX_STREAMS = int(os.getenv("JOB_EVENTS_MAX_STREAMS", 4))
+JOB_EVENTS_BUSY_RETRY_MS = 10000
+_job_event_streams = threading.BoundedSemaphore(JOB_EVENTS_MAX_STREAMS)
+
+
+def get_job_summaries():
+    """ジョブ一覧画面用にジョブの状態をまとめる"""
     jobs = job_model.get_all_jobs()
-    return jsonify({
+    return {
         job_id: {
             "status": job["status"],
             "error": job.get("error", None)
         }
         for job_id, job in jobs.items()
-    })
+    }
+
+
+def format_sse(data, event=None, event_id=None):
+    """Server-Sent Eventsの1イベント分の文字列を作成"""
+    message = ""
+    if event_id:
+        message += f"id: {event_id}\n"
+    if event:
+        message += f"event: {event}\n"
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+@simu_views.route("/api/simulations", methods=["GET"])
+def get_simulations_api():
+    return jsonify(get_job_summaries())
+
+
+@simu_views.route("/api/simulations/events", methods=["GET"])
+def get_simulation_events_api():
+    """
+    ジョブの状態遷移をServer-Sent Eventsで配信する。
+    接続時に一覧(snapshot)を1回送り、その後はワーカーが追加したイベント(job)だけを送る。
+    再接続時はLast-Event-IDから続きを送るので一覧は送り直さない。
+    同時に保持する接続はJOB_EVENTS_MAX_STREAMSまでで、超えた分は溜まっているイベントを送って閉じる。
+    """
+    last_id = request.headers.get("Last-Event-ID")
+
+    def generate():
+        streaming = _job_event_streams.acquire(blocking=False)
+        try:
+            event_id = last_id
+            yield f"retry: {JOB_EVENTS_RETRY_MS if streaming else JOB_EVENTS_BUSY_RETRY_MS}\n\n"
+            if not event_id or not job_model.has_job_events_since(event_id):
+                # 一覧を取得する前のイベントIDから読むことで取りこぼしを防ぐ
+                event_id = job_model.get_last_job_event_id()
+                yield format_sse(get_job_summaries(), event="snapshot", event_id=event_id)
+
+            if not streaming:
+                # 上限に達しているので待たずに閉じる
+                for event_id, event in job_model.read_job_events(event_id, block_ms=None):
+                    yield format_sse(event, event="job", event_id=event_id)
+                return
+
+            deadline = time.time() + JOB_EVENTS_MAX_DURATION
+            while time.time() < deadline:
+                events = job_model.read_job_events(event_id, block_ms=JOB_EVENTS_BLOCK_MS)
+                if not events:
+                    yield ": keepalive\n\n"  # プロキシに接続を切られないようにする
+                    continue
+                for event_id, event in events:
+                    yield format_sse(event, event="job", event_id=event_id)
+        finally:
+            if streaming:
+                _job_event_streams.release()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@simu_views.route("/api/workers", methods=["GET"])
+def get_workers_api():
+    return jsonify(job_model.get_worker_slots())
+
+
+@simu_views.route("/api/results/stats", methods=["GET"])
+def get_result_stats_api():
+    return jsonify(job_model.get_result_stats())
 
 
 @simu_views.route("/api/simulations/<job_id>", methods=["GET"])
@@ -67,7 +148,17 @@ def get_simulation_status_api(job_id):
     job_data = job_model.get_job_meta(job_id)
     if job_data is None:
         return jsonify({"error": f"Job with ID {job_id} not found."}), 404
-    return jsonify({"job_id": job_id, "status": job_data.get("status", "unknown")})
+    return jsonify({
+        "job_id": job_id,
+        "status": job_data.get("status", "unknown"),
+        "timings": job_model.get_job_timings(job_id),
+    })
+
+
+@simu_views.route("/api/metrics/timings", methods=["GET"])
+def get_timing_metrics_api():
+    """処理段階ごとの所要時間の統計（直近のジョブから計算したパーセンタイル）"""
+    return jsonify(job_model.get_timing_stats())
 
 
 @simu_views.route("/api/simulations/<job_id>/result", methods=["GET"])
@@ -99,79 +190,88 @@ def run_simulate_api():
     uploaded_file_path = os.path.join(job_model.SIMULATION_DIR, file.filename)
     file.save(uploaded_file_path)
 
-    job_id = job_model.create_job(uploaded_file_path)
+    job_id = job_model.create_job(uploaded_file_path, priority="interactive")
     return jsonify({"job_id": job_id}), 202
 
 
-@simu_views.route("/api/simulate_now/<output_format>", methods=["POST"])
-def run_simulate_now_api(output_format):
+# 即時シミュレーションで選択できる特性
+SIMULATE_NOW_MODELS = {
+    'iv': JFET_IV_Characteristic,
+    'vgs_id': JFET_Vgs_Id_Characteristic,
+    'gm_vgs': JFET_Gm_Vgs_Characteristic,
+    'gm_id': JFET_Gm_Id_Characteristic,
+}
+SIMULATE_NOW_MAX_WAIT = 20  # ロングポーリングで1回のリクエストが待つ最大秒数
+
+
+def load_measurement_data(measurement_data_id):
+    """プロットに重ねる実験データを取得"""
+    if not measurement_data_id or measurement_data_id == 'None':
+        return None
+
+    experiment_data_df = get_experiment_data_by_id_or_data_id(measurement_data_id, by_data_id=False)
+    data_dict = experiment_data_df['data'].iloc[0]  # 最初の行のデータを取得
+    data_json_str = json.dumps(data_dict)
+    df = pd.read_json(data_json_str, orient='split')
+    return {
+        "x": df.iloc[:, 0].tolist(),  # Vdsをxに
+        "y": df.iloc[:, 1].tolist()   # Idをyに
+    }
+
+
+def create_simulate_now_model(simulation_name, device_name, device_type, spice_string, config=None):
+    """シミュレーションの種類に応じてモデルを作成し、設定を反映する"""
+    model_class = SIMULATE_NOW_MODELS.get(simulation_name)
+    if model_class is None:
+        raise ValueError(f"Unsupported simulation type: {simulation_name}")
+
+    model = model_class(device_name, device_type, spice_string)
+    for key, value in (config or {}).items():
+        model.update_config(key, value)  # モデルの設定を更新
+    return model
+
+
+def parse_simulate_now_form(form_data):
     """
-    /api/simulate_now/<output_format>エンドポイント
-    - output_formatが'image'の場合は画像を返す
-    - output_formatが'json'の場合はJSONを返す
+    即時シミュレーションのフォームを解析する。
+
+    Returns:
+        tuple: (コンテキスト, None) または (None, エラーレスポンス)。
+               コンテキストはモデルを作り直すための情報で、ジョブのメタデータに保存される。
     """
-    # ステップ 1: フォームデータのバリデーション
-    form = AddModelForm(request.form)
-    if not (request.method == 'POST' and form.validate()):
-        return jsonify({"error": "Invalid spice_string format or missing fields."}), 400
+    # フォームデータのバリデーション
+    form = AddModelForm(form_data)
+    if not form.validate():
+        return None, (jsonify({"error": "Invalid spice_string format or missing fields."}), 400)
 
     spice_string = form.spice_string.data
-    measurement_data_id = request.form.get('measurement_data_id', None)  # ここで取得
-    simulation_name = request.form.get('simulation_name', 'iv')
-    
-    if measurement_data_id == 'None':
-        measurement_data_id = None  # 'None'が選ばれた場合はNoneに変換
-    
-    measurement_data = None
-
-    if measurement_data_id:
-        # 実験データを取得
-        experiment_data_df = get_experiment_data_by_id_or_data_id(measurement_data_id, by_data_id=False)
-        data_dict = experiment_data_df['data'].iloc[0]  # 最初の行のデータを取得
-        data_json_str = json.dumps(data_dict)
-        df = pd.read_json(data_json_str, orient='split')
-        measurement_data = {
-            "x": df.iloc[:, 0].tolist(),  # Vdsをxに
-            "y": df.iloc[:, 1].tolist()   # Idをyに
-        }
+    simulation_name = form_data.get('simulation_name', 'iv')
 
-    # ステップ 2: Spice文字列の解析
+    # Spice文字列の解析
     try:
         parser = SpiceModelParser()
         parsed_params = parser.parse(spice_string)
         device_name = parsed_params['device_name']
         device_type = parsed_params['device_type']
     except Exception as e:
-        return jsonify({"error": f"Error parsing spice_string: {str(e)}"}), 400
+        return None, (jsonify({"error": f"Error parsing spice_string: {str(e)}"}), 400)
 
-    # ステップ 3: デバイスタイプの確認とモデルインスタンスの生成
+    # デバイスタイプとシミュレーションの種類の確認
     if device_type not in JFET_IV_Characteristic.VALID_TYPES:
-        return jsonify({"error": f"Unsupported device type: {device_type}"}), 400
-
-    # シミュレーションの種類に応じてモデルを選択
-    if simulation_name == 'iv':
-        model = JFET_IV_Characteristic(device_name, device_type, spice_string)
-    elif simulation_name == 'vgs_id':
-        model = JFET_Vgs_Id_Characteristic(device_name, device_type, spice_string)
-    elif simulation_name == 'gm_vgs':
-        model = JFET_Gm_Vgs_Characteristic(device_name, device_type, spice_string)
-    elif simulation_name == 'gm_id':
-        model = JFET_Gm_Id_Characteristic(device_name, device_type, spice_string)
-    else:
-        return jsonify({"error": f"Unsupported simulation type: {simulation_name}"}), 400
-
+        return None, (jsonify({"error": f"Unsupported device type: {device_type}"}), 400)
+    if simulation_name not in SIMULATE_NOW_MODELS:
+        return None, (jsonify({"error": f"Unsupported simulation type: {simulation_name}"}), 400)
 
-    # シミュレーション設定
-    configs = model.show_default_config()
-
-    for key, default_value in configs.items():
+    # シミュレーション設定（デフォルト値と異なるものだけを残す）
+    config = {}
+    for key, default_value in SIMULATE_NOW_MODELS[simulation_name].show_default_config().items():
 
         if key == 'LIMITS':
             continue
 
-        # request.form.get()で、フォームから取得した値があればそれを使い、なければdefault_valueを使う
-        value = request.form.get(key, default_value)  # デフォルト値を設定
-        
+        # フォームから取得した値があればそれを使い、なければdefault_valueを使う
+        value = form_data.get(key, default_value)
+
         # valueを数値に変換（デフォルト値も数値に変換して比較）
         try:
             value = float(value)  # 文字列を数値に変換
@@ -181,53 +281,222 @@ def run_simulate_now_api(output_format):
 
         if value != default_value:  # 値が異なる場合のみ処理
             print(f"Simulation Config Set {key} -> {value}, default: {default_value}")
-            model.update_config(key, value)  # モデルの設定を更新
-
-
-    # ステップ 4: シミュレーション実行と結果取得
-    try:
-        netfile_path = model.build()  # ネットリストの作成
-        job_id = job_model.create_job(netfile_path)  # ジョブIDを生成
-        zip_data = job_model.get_job_result_with_notification(job_id)  # 結果を取得
-        extracted_files = file_extractor.extract(zip_data, job_id)  # ファイルを解凍
+            config[key] = value
+
+    context = {
+        "simulation_name": simulation_name,
+        "device_name": device_name,
+        "device_type": device_type,
+        "spice_string": spice_string,
+        "config": config,
+        "measurement_data_id": form_data.get('measurement_data_id', None),
+    }
+    return context, None
+
+
+def load_simulation_artifacts(model, artifacts):
+    """ジョブの結果をモデルに読み込む（.tracesがあれば優先する）"""
+    trace_data = job_model.find_artifact(artifacts, ".traces")
+    raw_data = job_model.find_artifact(artifacts, ".raw")
+    log_data = job_model.find_artifact(artifacts, ".log")
+
+    if (trace_data is None and raw_data is None) or log_data is None:
+        raise ValueError("Missing .raw or .log files.")
+
+    if trace_data is not None:
+        model.load_trace_payload(trace_data, log_data)
+    else:
+        model.load_results_from_memory(raw_data, log_data)
 
-        raw_file = extracted_files.get(".raw")
-        log_file = extracted_files.get(".log")
 
-        if not raw_file or not log_file:
-            return jsonify({"error": "Missing .raw or .log files."}), 500
+# プロットの配列をまとめたバイナリの識別子
+PLOT_ARRAYS_MAGIC = b"SMMP"
 
-        model.load_results(raw_file, log_file)  # 結果をモデルにロード
-    except Exception as e:
-        return jsonify({"error": f"Simulation error: {str(e)}"}), 500
 
-    # ステップ 5: 応答形式の確認 (画像またはJSON)
+def encode_plot_arrays(plot_item, arrays):
+    """
+    データを空にした図のJSONとfloat32の配列を1つのバイナリにまとめる。
+    形式: "SMMP" + ヘッダ長(uint32 LE) + JSONヘッダ + 各配列（float32 LE）
+    ヘッダの sources[データソース名][列名] に配列の {"offset", "count"} が入る。
+    """
+    header = {"plot": plot_item, "dtype": "<f4", "sources": {}}
+    chunks = []
+    offset = 0
+    for name, columns in arrays.items():
+        header["sources"][name] = {}
+        for column, values in columns.items():
+            header["sources"][name][column] = {"offset": offset, "count": len(values)}
+            chunks.append(values.tobytes())
+            offset += values.nbytes
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    # ブラウザのFloat32Arrayで直接参照できるよう配列の先頭を4バイト境界に揃える
+    header_bytes += b" " * (-(8 + len(header_bytes)) % 4)
+    return PLOT_ARRAYS_MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes + b"".join(chunks)
+
+
+def render_simulation_output(model, output_format, job_id, measurement_data=None):
+    """
+    シミュレーション結果を返す
+    - image: 画像
+    - json: BokehのJSON (json_item)
+    - arrays: データを空にしたjson_itemと、base64のfloat32配列のJSON
+    - binary: arraysと同じ内容をバイナリで返す（encode_plot_arraysの形式）
+    """
     if output_format == 'image':
-        # ステップ 6: 画像の生成と送信
+        # 画像の生成と送信
         try:
-            plot_file = model.plot()
-            with open(plot_file, 'rb') as f:
-                return send_file(
-                    BytesIO(f.read()),
-                    as_attachment=True,
-                    download_name=f"{job_id}.png",
-                    mimetype='image/png'
-                )
+            png_data = model.plot()  # メモリ上で描画したPNG
+            return send_file(
+                BytesIO(png_data),
+                as_attachment=True,
+                download_name=f"{job_id}.png",
+                mimetype='image/png'
+            )
         except Exception as e:
             return jsonify({"error": f"Error generating plot image: {str(e)}"}), 500
 
     elif output_format == 'json':
-        # ステップ 7: JSONデータの生成と送信
+        # JSONデータの生成と送信
         try:
             json_data = model.plot(json=True, measurement_data=measurement_data)
             return jsonify(json_data)
         except Exception as e:
             return jsonify({"error": f"Error generating plot data: {str(e)}"}), 500
 
+    elif output_format in ('arrays', 'binary'):
+        # 波形をJSONの数値の配列にせず、float32のバイト列のまま送る
+        try:
+            plot_item, arrays = model.plot_arrays(measurement_data=measurement_data)
+        except Exception as e:
+            return jsonify({"error": f"Error generating plot data: {str(e)}"}), 500
+
+        if output_format == 'binary':
+            return Response(encode_plot_arrays(plot_item, arrays), mimetype='application/octet-stream')
+        return jsonify({
+            "plot": plot_item,
+            "dtype": "<f4",
+            "sources": {
+                name: {column: base64.b64encode(values.tobytes()).decode('ascii') for column, values in columns.items()}
+                for name, columns in arrays.items()
+            },
+        })
+
     # 無効な形式の場合のエラー
     return jsonify({"error": f"Unsupported output format: {output_format}"}), 400
 
 
+def record_model_timings(job_id, model):
+    """モデルで計測した処理段階ごとの所要時間をジョブに記録（記録した分は消す）"""
+    job_model.record_timings(job_id, model.timings)
+    model.timings.clear()
+
+
+def submit_simulate_now_job(context):
+    """コンテキストからネットリストを作成してジョブを投入"""
+    model = create_simulate_now_model(context["simulation_name"], context["device_name"],
+                                      context["device_type"], context["spice_string"], context["config"])
+    filename, netlist_data = model.render()  # ネットリストの作成（ファイルには保存しない）
+    # 必要な波形だけをワーカーで抽出させる
+    # 設定から見積もったコストでキューの順序を決める（上限を超えた場合はJobCostError）
+    job_id = job_model.create_job_from_data(filename, netlist_data, priority="interactive",
+                                            traces=model.REQUIRED_TRACES, context=context,
+                                            cost=model.estimate_cost())
+    record_model_timings(job_id, model)
+    return model, job_id
+
+
+@simu_views.route("/api/simulate_now/<output_format>", methods=["POST"])
+def run_simulate_now_api(output_format):
+    """
+    /api/simulate_now/<output_format>エンドポイント（結果が出るまで待つ）
+    - output_formatが'image'の場合は画像を返す
+    - output_formatが'json'の場合はJSONを返す
+    - output_formatが'arrays'または'binary'の場合は図と配列を分けて返す（render_simulation_outputを参照）
+    """
+    context, error = parse_simulate_now_form(request.form)
+    if error:
+        return error
+
+    try:
+        measurement_data = load_measurement_data(context["measurement_data_id"])
+        model, job_id = submit_simulate_now_job(context)
+        artifacts = job_model.get_job_result_with_notification(job_id)  # 結果を取得
+        if not artifacts:
+            return jsonify({"error": "Simulation failed or timed out."}), 500
+        load_simulation_artifacts(model, artifacts)  # 結果をモデルにロード
+    except JobCostError as e:
+        # 413はアップロードサイズの超過に使っているので、見積もりコストの超過は422で返す
+        return jsonify({"error": str(e)}), 422
+    except Exception as e:
+        return jsonify({"error": f"Simulation error: {str(e)}"}), 500
+
+    response = render_simulation_output(model, output_format, job_id, measurement_data)
+    record_model_timings(job_id, model)
+    return response
+
+
+@simu_views.route("/api/simulate_now/jobs", methods=["POST"])
+def submit_simulate_now_api():
+    """
+    即時シミュレーションのジョブを投入してすぐにジョブIDを返す。
+    結果は /api/simulate_now/jobs/<job_id>/<output_format> で取得する。
+    """
+    context, error = parse_simulate_now_form(request.form)
+    if error:
+        return error
+
+    try:
+        _, job_id = submit_simulate_now_job(context)
+    except JobCostError as e:
+        # 413はアップロードサイズの超過に使っているので、見積もりコストの超過は422で返す
+        return jsonify({"error": str(e)}), 422
+    except Exception as e:
+        return jsonify({"error": f"Simulation error: {str(e)}"}), 500
+
+    return jsonify({"job_id": job_id, "status": "pending"}), 202
+
+
+@simu_views.route("/api/simulate_now/jobs/<job_id>/<output_format>", methods=["GET"])
+def poll_simulate_now_api(job_id, output_format):
+    """
+    即時シミュレーションの結果を取得する。
+    ?wait=秒数 を指定すると完了するまで最大SIMULATE_NOW_MAX_WAIT秒待つ（ロングポーリング）。
+    未完了の場合は202とステータスを返す。
+    """
+    job_data = job_model.get_job_meta(job_id)
+    if not job_data or "context" not in job_data:
+        return jsonify({"error": f"Job with ID {job_id} not found."}), 404
+
+    wait = min(max(request.args.get("wait", 0, type=float), 0), SIMULATE_NOW_MAX_WAIT)
+    if job_data.get("status") not in ("completed", "failed") and wait > 0:
+        # ジョブ専用の完了通知を待つ（gthreadワーカーのスレッドを1つ使うだけ）
+        if job_model.wait_for_job(job_id, wait):
+            job_data = job_model.get_job_meta(job_id) or job_data
+
+    status = job_data.get("status", "unknown")
+    if status == "failed":
+        return jsonify({"job_id": job_id, "status": status, "error": job_data.get("error")}), 500
+    if status != "completed":
+        return jsonify({"job_id": job_id, "status": status}), 202
+
+    context = job_data["context"]
+    try:
+        measurement_data = load_measurement_data(context.get("measurement_data_id"))
+        model = create_simulate_now_model(context["simulation_name"], context["device_name"],
+                                          context["device_type"], context["spice_string"], context["config"])
+        artifacts = job_model.get_completed_result(job_id, job_data)
+        if not artifacts:
+            return jsonify({"error": "Result data not found"}), 404
+        load_simulation_artifacts(model, artifacts)
+    except Exception as e:
+        return jsonify({"error": f"Simulation error: {str(e)}"}), 500
+
+    response = render_simulation_output(model, output_format, job_id, measurement_data)
+    record_model_timings(job_id, model)
+    return response
+
+
 
 ## test用
 @simu_views.route("/build")
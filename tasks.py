@@ -1,5 +1,8 @@
 import os  # 環境変数の取得
+import time
+from io import BytesIO
 from celery import Celery  # Celeryタスクの作成
+from celery.signals import task_prerun, task_postrun
 
 # データベース関連
 from models.db_model import (
@@ -18,13 +21,16 @@ from simulation.jfet import (
     JFET_Basic_Performance
 )
 
-from simulation.file_extractor import FileExtractor  # ファイル抽出
 from simulation.job_model import JobModel
 
 # 環境変数からREDIS_HOSTを取得（デフォルトはlocalhost）
 redis_host = os.getenv('REDIS_HOST', 'localhost')
 
-file_extractor = FileExtractor()
+# 特性シミュレーションの実行方法
+# fanout: 特性ごとのジョブを一度に投入して並列に実行（ワーカーのスロットに空きがある場合に速い）
+# bundle: 全ての特性を1つのジョブにまとめて実行（キューの往復と転送が1回で済む）
+PLOT_SIMULATION_MODE = os.getenv('PLOT_SIMULATION_MODE', 'fanout')
+
 job_model = JobModel(redis_host=redis_host)
 
 # Celeryインスタンスを作成
@@ -40,6 +46,28 @@ celery.conf.broker_connection_retry_on_startup = True  # 起動時の接続再
 # celery.conf.task_reject_on_worker_lost = True
 
 
+# タスクの開始時刻（所要時間をメトリクスに記録するため）
+_task_start_times = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    _task_start_times[task_id] = time.perf_counter()
+
+
+@task_postrun.connect
+def record_task_duration(task_id=None, task=None, retval=None, state=None, **kwargs):
+    start_time = _task_start_times.pop(task_id, None)
+    if start_time is None:
+        return
+    # タスクはエラーを例外ではなく {"status": "error"} で返す
+    status = retval.get("status", state) if isinstance(retval, dict) else state
+    try:
+        job_model.record_task_duration(task.name.rsplit(".", 1)[-1], status, time.perf_counter() - start_time)
+    except Exception as e:
+        print(f"Failed to record task duration: {e}")
+
+
 class JobError(Exception):
     """ジョブ処理中のエラー"""
     pass
@@ -68,55 +96,143 @@ def get_device_data(data_id):
     return device_name, device_type, spice_string
 
 
-def run_simulation(data_id, characteristic_class):
+def load_artifacts(model, job_id, artifacts, stem=None):
     """
-    指定された特性クラスに基づいてシミュレーションを実行し、画像を生成します。
+    ファイルごとに保存されたジョブ結果をモデルにメモリ上で読み込みます。
+
+    Args:
+        model: 結果を読み込むモデル
+        job_id (str): 結果を返したジョブのID
+        artifacts (dict): ファイル名 -> バイナリデータ
+        stem (str): バンドルジョブの場合のネットリスト名（拡張子なし）
+    """
+    model.job_id = job_id
+    log_data = job_model.find_artifact(artifacts, ".log", stem)
+    # ワーカーで波形を抽出した場合は.rawの代わりに.tracesが返される
+    trace_data = job_model.find_artifact(artifacts, ".traces", stem)
+    if trace_data is not None and log_data is not None:
+        model.load_trace_payload(trace_data, log_data)
+        return
+
+    raw_data = job_model.find_artifact(artifacts, ".raw", stem)
+    if raw_data is None or log_data is None:
+        raise JobError(f"シミュレーション結果が見つかりません。{model.simulation_name}, {model.device_name}")
+    model.load_results_from_memory(raw_data, log_data)
+
+
+def record_model_timings(model, job_id=None):
+    """モデルで計測した処理段階ごとの所要時間をジョブに記録（記録した分は消す）"""
+    job_id = job_id or model.job_id
+    if job_id:
+        job_model.record_timings(job_id, model.timings)
+        model.timings.clear()
+
+
+def get_required_traces(models):
+    """モデルが必要とする波形名をまとめる（1つでも.raw全体が必要なモデルがあればNone）"""
+    traces = []
+    for model in models:
+        if model.REQUIRED_TRACES is None:
+            return None
+        traces.extend(trace for trace in model.REQUIRED_TRACES if trace not in traces)
+    return traces
+
+
+def create_model(data_id, characteristic_class):
+    """
+    データIDのデバイスについて、指定された特性クラスのモデルを作成します。
 
     Args:
         data_id (int): データID
         characteristic_class (class): シミュレーションに使用する特性クラス
-
-    Returns:
-        model: シミュレーション結果を格納したモデル
     """
     # デバイス情報を取得
     device_name, device_type, spice_string = get_device_data(data_id)
-    
-    # # device_typeが特性クラスに対応していない場合、エラーを発生させる
+
+    # device_typeが特性クラスに対応していない場合、エラーを発生させる
     if device_type not in characteristic_class.VALID_TYPES:
         raise ValueError(f"無効なdevice_typeです。device_type: {device_type}")
-    
-    # モデルのインスタンスを作成
-    model = characteristic_class(device_name, device_type, spice_string)
 
-    # ネットリストを生成
-    netfile_path = model.build()
+    return characteristic_class(device_name, device_type, spice_string)
 
-    # リモートでシミュレーションを実行
-    job_id = job_model.create_job(netfile_path)
 
-    # ジョブが終わるのを待つ
-    zip_data = job_model.get_job_result_with_notification(job_id)
+def estimate_cost(models):
+    """モデルの設定から見積もったコストの合計"""
+    costs = [model.estimate_cost() for model in models]
+    return {key: sum(cost[key] for cost in costs) for key in ("points", "seconds")}
 
-    if not zip_data:
-        raise JobError(f"シミュレーションが失敗しました。{characteristic_class.__name__}, {device_name}")
-    
-    # シミュレーション結果を抽出
-    extracted_files = file_extractor.extract(zip_data, job_id)
 
-    # 結果ファイルを取得
-    raw_file = extracted_files.get(".raw")
-    log_file = extracted_files.get(".log")
-    if raw_file and log_file:
-        model.load_results(raw_file, log_file)
+def submit_simulation(models, continuation, **kwargs):
+    """
+    モデルのネットリストを作成してジョブを投入し、完了時にワーカーから続きのタスクを実行させます。
+    Celeryのワーカーはシミュレーションの完了を待ちません。
 
-    return model
+    Args:
+        models (list): シミュレーションするモデル（2つ以上ならバンドルジョブ）
+        continuation: 完了時に実行するタスク（job_idとstatusが追加で渡される）
+        **kwargs: 続きのタスクに渡す引数
+
+    Returns:
+        str: ジョブID
+    """
+    netlists = [model.render() for model in models]
+    traces = get_required_traces(models)
+    cost = estimate_cost(models)  # キューの順序と振り分けに使う
+    on_complete = {"task": continuation.name, "kwargs": kwargs}
+    if len(netlists) == 1:
+        filename, netlist_data = netlists[0]
+        job_id = job_model.create_job_from_data(filename, netlist_data, priority="batch", traces=traces,
+                                                on_complete=on_complete, cost=cost)
+    else:
+        job_id = job_model.create_bundle_job(netlists, base_name=f"data_{kwargs.get('data_id', 'bundle')}",
+                                             priority="batch", traces=traces, on_complete=on_complete, cost=cost)
+    for model in models:
+        record_model_timings(model, job_id)
+
+    # キャッシュから完了済みとして登録されたジョブはワーカーを経由しないので、ここで続きを実行する
+    if (job_model.get_job_meta(job_id) or {}).get("cached"):
+        continuation.delay(job_id=job_id, status="completed", **kwargs)
+
+    return job_id
+
+
+def load_job_results(job_id, status, models, stems=None):
+    """
+    完了したジョブの結果をモデルに読み込みます。
+
+    Args:
+        job_id (str): ジョブID
+        status (str): ワーカーから通知されたジョブのステータス
+        models (list): 結果を読み込むモデルのリスト
+        stems (list): バンドルジョブの場合の各モデルのネットリスト名（拡張子なし）
+    """
+    job_data = job_model.get_job_meta(job_id) or {}
+    artifacts = job_model.get_completed_result(job_id, job_data) if status == "completed" else None
+    if not artifacts:
+        error = job_data.get("error") or "結果が見つかりません"
+        raise JobError(f"シミュレーションが失敗しました。{job_id}: {error}")
+
+    for model, stem in zip(models, stems or [None] * len(models)):
+        load_artifacts(model, job_id, artifacts, stem)
+
+
+# 画像を生成する特性（シミュレーション名 -> 特性クラス）
+PLOT_CHARACTERISTICS = {
+    characteristic_class.get_simulation_name(): characteristic_class
+    for characteristic_class in (
+        JFET_IV_Characteristic,
+        JFET_Vgs_Id_Characteristic,
+        JFET_Gm_Vgs_Characteristic,
+        JFET_Gm_Id_Characteristic,
+    )
+}
 
 
 @celery.task
 def run_basic_performance_simulation(data_id):
     """
-    非同期でシミュレーションを実行し、結果をデータベースに登録します。
+    基本性能のシミュレーションを投入します。
+    結果の登録はシミュレーションの完了時にprocess_basic_performanceで行います。
 
     Args:
         data_id (int): データID
@@ -125,11 +241,35 @@ def run_basic_performance_simulation(data_id):
         dict: 実行結果
     """
     try:
-        # シミュレーションを実行
-        model = run_simulation(data_id, JFET_Basic_Performance)
+        model = create_model(data_id, JFET_Basic_Performance)
+        job_id = submit_simulation([model], process_basic_performance, data_id=data_id)
+
+        return {"status": "submitted", "data_id": data_id, "job_id": job_id}
+
+    except Exception as e:
+        # エラー処理
+        return {"status": "error", "message": f"Error: {str(e)}"}
+
+
+@celery.task
+def process_basic_performance(job_id, status, data_id):
+    """
+    基本性能のシミュレーションの完了時にワーカーから呼ばれ、結果をデータベースに登録します。
+
+    Args:
+        job_id (str): ジョブID
+        status (str): ジョブのステータス
+        data_id (int): データID
 
-        # 結果を解析
+    Returns:
+        dict: 実行結果
+    """
+    try:
+        # 結果を読み込んで解析
+        model = create_model(data_id, JFET_Basic_Performance)
+        load_job_results(job_id, status, [model])
         result = model.get_basic_performance()
+        record_model_timings(model)
 
         # 必要なパラメータを抽出
         idss = result.get('id')
@@ -147,32 +287,66 @@ def run_basic_performance_simulation(data_id):
         # エラー処理
         return {"status": "error", "message": f"Error: {str(e)}"}
 
+
 @celery.task
 def run_and_store_plots(data_id):
     """
-    非同期でJFETの特性をシミュレーションし、生成した画像をデータベースに登録します。
+    JFETの特性のシミュレーションを投入します。
+    画像の生成と登録はシミュレーションの完了時にprocess_plotsで行います。
+    """
+
+    try:
+        models = [create_model(data_id, characteristic_class) for characteristic_class in PLOT_CHARACTERISTICS.values()]
+
+        if PLOT_SIMULATION_MODE == 'bundle':
+            # 全ての特性を1つのジョブでシミュレーション
+            groups = [models]
+        else:
+            # 特性ごとのジョブを一度に投入して並列に実行
+            groups = [[model] for model in models]
+
+        job_ids = []
+        for group in groups:
+            simulation_names = [model.simulation_name for model in group]
+            job_id = submit_simulation(group, process_plots, data_id=data_id, simulation_names=simulation_names)
+            job_ids.append(job_id)
+
+        return {"status": "submitted", "data_id": data_id, "job_ids": job_ids}
+
+    except Exception as e:
+        # エラー処理
+        return {"status": "error", "message": f"Error: {str(e)}"}
+
+
+@celery.task
+def process_plots(job_id, status, data_id, simulation_names):
+    """
+    特性のシミュレーションの完了時にワーカーから呼ばれ、画像を生成してデータベースに登録します。
+
+    Args:
+        job_id (str): ジョブID
+        status (str): ジョブのステータス
+        data_id (int): データID
+        simulation_names (list): ジョブに含まれる特性のシミュレーション名
     """
 
     try:
-        # シミュレーションと画像登録をまとめて行う
-        characteristic_models = [
-            JFET_IV_Characteristic,
-            JFET_Vgs_Id_Characteristic,
-            JFET_Gm_Vgs_Characteristic,
-            JFET_Gm_Id_Characteristic
-        ]
-
-        
-        for characteristic_class in characteristic_models:
-            model = run_simulation(data_id, characteristic_class)
-            image_path = model.plot()  # 画像生成メソッド
+        models = [create_model(data_id, PLOT_CHARACTERISTICS[name]) for name in simulation_names]
+        stems = None
+        if len(models) > 1:
+            # バンドルジョブの結果はネットリストごとの名前で格納されている
+            stems = [os.path.splitext(model.get_netlist_filename())[0] for model in models]
+        load_job_results(job_id, status, models, stems)
+
+        for model in models:
+            png_data = model.plot()  # 画像生成メソッド（メモリ上のPNG）
+            record_model_timings(model)
 
             # simulation_name プロパティを使用して画像タイプを決定
             image_type = model.simulation_name
 
             # 画像をデータベースに登録
-            with open(image_path, 'rb') as image_file:
-                save_image_to_db(data_id, image_file, image_type, 'png')
+            save_image_to_db(data_id, BytesIO(png_data), image_type, 'png')
 
             update_simulation_done(data_id)
 
@@ -181,5 +355,3 @@ def run_and_store_plots(data_id):
     except Exception as e:
         # エラー処理
         return {"status": "error", "message": f"Error: {str(e)}"}
-
-
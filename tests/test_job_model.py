@@ -0,0 +1,173 @@
+import json
+import time
+
+import fakeredis
+import pytest
+
+from simulation.job_model import JobModel, ATTACH_INFLIGHT_SCRIPT
+
+pytest.importorskip("lupa")  # fakeredisでLuaのスクリプトを実行するために必要
+
+
+@pytest.fixture
+def job_model():
+    model = JobModel()
+    model.redis = fakeredis.FakeRedis()
+    model.attach_inflight = model.redis.register_script(ATTACH_INFLIGHT_SCRIPT)
+    return model
+
+
+def submit(job_model, index):
+    return job_model.create_job_from_data(f"job_{index}.net", f"* netlist {index}\n".encode(), priority="batch")
+
+
+def set_status(job_model, job_id, **kwargs):
+    key = f"{job_model.REDIS_JOB_PREFIX}{job_id}:meta"
+    job_data = json.loads(job_model.redis.get(key))
+    job_data.update(kwargs)
+    job_model.redis.set(key, json.dumps(job_data))
+
+
+def finish(job_model, job_id, status="completed", **kwargs):
+    # ワーカーのupdate_jobと同じく、終了したジョブの一覧と結果の参照数も更新する
+    set_status(job_model, job_id, status=status, **kwargs)
+    job_model.redis.zadd(job_model.FINISHED_JOBS, {job_id: time.time()})
+    if kwargs.get("result_key"):
+        job_model.redis.hincrby(job_model.RESULT_REFS, kwargs["result_key"], 1)
+
+
+def test_trim_keeps_pending_jobs(job_model):
+    job_ids = [submit(job_model, i) for i in range(40)]
+
+    assert job_model.redis.zcard(job_model.JOB_QUEUES["batch"]) == 40
+    for job_id in job_ids:
+        assert job_model.get_job_meta(job_id) is not None
+        assert job_model.get_job_file(job_id) is not None
+
+
+def test_trim_reads_only_finished_jobs(job_model, monkeypatch):
+    job_ids = [submit(job_model, i) for i in range(job_model.MAX_JOBS + 10)]
+    finish(job_model, job_ids[0])
+
+    # インデックス全体ではなく、削除するジョブのメタデータだけを読み込む
+    requested = []
+    mget = job_model.redis.mget
+    monkeypatch.setattr(job_model.redis, "mget", lambda keys: requested.append(list(keys)) or mget(keys))
+    submit(job_model, job_model.MAX_JOBS + 10)
+
+    assert requested == [[f"{job_model.REDIS_JOB_PREFIX}{job_ids[0]}:meta"]]
+    assert job_model.get_job_meta(job_ids[0]) is None
+    assert job_model.redis.zcard(job_model.FINISHED_JOBS) == 0
+
+
+def test_trim_removes_finished_jobs_first(job_model):
+    job_ids = [submit(job_model, i) for i in range(job_model.MAX_JOBS)]
+    for job_id in job_ids[:5]:
+        finish(job_model, job_id)
+
+    new_job_ids = [submit(job_model, i) for i in range(job_model.MAX_JOBS, job_model.MAX_JOBS + 3)]
+
+    for job_id in job_ids[:3]:
+        assert job_model.get_job_meta(job_id) is None
+    for job_id in job_ids[3:] + new_job_ids:
+        assert job_model.get_job_meta(job_id) is not None
+    assert job_model.redis.zcard(job_model.REDIS_JOB_INDEX) == job_model.MAX_JOBS
+
+
+def test_trim_keeps_result_referenced_by_follower(job_model):
+    job_ids = [submit(job_model, i) for i in range(job_model.MAX_JOBS)]
+    primary_id, follower_id = job_ids[0], job_ids[1]
+    result_key = f"{job_model.REDIS_RESULT_PREFIX}{primary_id}"
+    job_model.redis.hset(result_key, "out.raw", b"data")
+    job_model.redis.zadd(job_model.RESULT_INDEX, {result_key: 0})
+    finish(job_model, primary_id, result_key=result_key)
+    finish(job_model, follower_id, result_key=result_key, attached_to=primary_id)
+
+    # 実行元のジョブが削除されても、相乗りしたジョブが参照している結果は残る
+    submit(job_model, job_model.MAX_JOBS)
+    assert job_model.get_job_meta(primary_id) is None
+    assert job_model.redis.exists(result_key)
+
+    # 相乗りしたジョブも削除されたら結果も削除される
+    submit(job_model, job_model.MAX_JOBS + 1)
+    assert job_model.get_job_meta(follower_id) is None
+    assert not job_model.redis.exists(result_key)
+
+
+def test_duplicate_job_attaches_to_pending_job(job_model):
+    primary_id = submit(job_model, 0)
+    follower_id = submit(job_model, 0)
+
+    # 相乗りしたジョブのメタデータとインデックスは相乗りの登録と同時に書き込まれる
+    follower = job_model.get_job_meta(follower_id)
+    assert follower["status"] == "pending"
+    assert follower["attached_to"] == primary_id
+    assert job_model.redis.zscore(job_model.REDIS_JOB_INDEX, follower_id) is not None
+    assert job_model.redis.lrange(f"{job_model.REDIS_JOB_PREFIX}{primary_id}:followers", 0, -1) == [follower_id.encode()]
+    assert job_model.get_job_file(follower_id) is None
+    assert job_model.redis.zrange(job_model.JOB_QUEUES["batch"], 0, -1) == [primary_id.encode()]
+
+
+def test_finished_primary_is_not_attached_to(job_model):
+    primary_id = submit(job_model, 0)
+    set_status(job_model, primary_id, status="completed")
+
+    job_id = submit(job_model, 0)
+    assert "attached_to" not in job_model.get_job_meta(job_id)
+    assert job_model.redis.get(f"{job_model.INFLIGHT_PREFIX}{job_model.get_job_meta(job_id)['cache_key']}") == job_id.encode()
+
+
+def complete_with_result(job_model, job_id):
+    # ワーカーと同じく結果を保存して完了させ、取得時にキャッシュへ登録させる
+    result_key = f"{job_model.REDIS_RESULT_PREFIX}{job_id}"
+    job_model.redis.hset(result_key, mapping={"__codec__": "none", "job.raw": b"raw data"})
+    job_model.redis.zadd(job_model.RESULT_INDEX, {result_key: time.time()})
+    finish(job_model, job_id, result_key=result_key)
+    return job_model.get_completed_result(job_id, job_model.get_job_meta(job_id))
+
+
+def test_cache_hit_keeps_result_after_cache_eviction(job_model):
+    first_id = submit(job_model, 0)
+    assert complete_with_result(job_model, first_id) == {"job.raw": b"raw data"}
+
+    job_id = submit(job_model, 0)
+    job_data = job_model.get_job_meta(job_id)
+    assert job_data["status"] == "completed" and job_data["cached"]
+    assert job_data["result_key"] == f"{job_model.REDIS_RESULT_PREFIX}{job_id}"
+
+    # 結果を取得する前にキャッシュから削除されても、複製した結果が返される
+    job_model.RESULT_CACHE_MAX_BYTES = 0
+    job_model.evict_cached_results()
+    assert job_model.redis.zcard(job_model.RESULT_CACHE_INDEX) == 0
+    assert job_model.get_job_result_with_notification(job_id, timeout=1) == {"job.raw": b"raw data"}
+
+
+def test_expired_cache_entries_are_swept(job_model):
+    job_id = submit(job_model, 0)
+    complete_with_result(job_model, job_id)
+    cache_key = job_model.get_job_meta(job_id)["cache_key"]
+    assert int(job_model.redis.get(job_model.RESULT_CACHE_BYTES)) > 0
+
+    # TTLで消えたエントリ
+    job_model.redis.delete(f"{job_model.RESULT_CACHE_PREFIX}{cache_key}")
+    job_model.redis.zadd(job_model.RESULT_CACHE_INDEX, {cache_key: time.time() - job_model.RESULT_CACHE_TTL - 1})
+
+    stats = job_model.get_result_stats()
+    assert stats["cache"] == {**stats["cache"], "bytes": 0, "count": 0}
+    assert stats["evictions"]["cache_expired"]["count"] == 1
+    assert not job_model.redis.hexists(job_model.RESULT_CACHE_SIZES, cache_key)
+
+
+def test_interactive_attach_moves_primary_to_interactive_lane(job_model):
+    primary_id = submit(job_model, 0)
+    primary = job_model.get_job_meta(primary_id)
+    follower_id = job_model.create_job_from_data("job_0.net", b"* netlist 0\n", priority="interactive")
+
+    assert job_model.get_job_meta(follower_id)["attached_to"] == primary_id
+    assert job_model.redis.zrange(job_model.JOB_QUEUES["batch"], 0, -1) == []
+    assert job_model.redis.zrange(job_model.JOB_QUEUES["interactive"], 0, -1) == [primary_id.encode()]
+    # 実行元のメタデータの優先度も移動後のキューに合わせる（他の項目はそのまま）
+    moved = job_model.get_job_meta(primary_id)
+    assert moved["priority"] == "interactive"
+    assert moved["cache_key"] == primary["cache_key"]
+    assert moved["created_at"] == pytest.approx(primary["created_at"])
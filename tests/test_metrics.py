@@ -0,0 +1,53 @@
+import time
+
+import fakeredis
+import pytest
+
+from simulation import metrics
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeRedis()
+
+
+def store(redis, result_key, size, last_access):
+    redis.set(result_key, b"x" * size)
+    redis.zadd(metrics.RESULT_INDEX, {result_key: last_access})
+    redis.hset(metrics.RESULT_SIZES, result_key, size)
+    redis.incrby(metrics.RESULT_BYTES, size)
+
+
+def test_evict_results_removes_least_recently_used(redis, monkeypatch):
+    monkeypatch.setattr(metrics, "RESULT_MAX_BYTES", 150)
+    store(redis, "result:old", 100, 1)
+    store(redis, "result:new", 100, 2)
+
+    metrics.evict_results(redis, keep="result:new")
+
+    assert not redis.exists("result:old")
+    assert redis.exists("result:new")
+    assert int(redis.get(metrics.RESULT_BYTES)) == 100
+    assert int(redis.hget(metrics.RESULT_EVICTION_STATS, "lru:bytes")) == 100
+
+
+def test_evict_results_keeps_the_only_new_result(redis, monkeypatch):
+    monkeypatch.setattr(metrics, "RESULT_MAX_BYTES", 50)
+    store(redis, "result:new", 100, 1)
+
+    metrics.evict_results(redis, keep="result:new")
+
+    assert redis.exists("result:new")
+    assert redis.zscore(metrics.RESULT_INDEX, "result:new") == 1
+
+
+def test_sweep_expired_results(redis):
+    store(redis, "result:expired", 100, time.time() - metrics.RESULT_TTL - 1)
+    store(redis, "result:alive", 100, time.time() - metrics.RESULT_TTL - 1)
+    redis.delete("result:expired")
+
+    metrics.sweep_expired_results(redis)
+
+    assert redis.zrange(metrics.RESULT_INDEX, 0, -1) == [b"result:alive"]
+    assert int(redis.get(metrics.RESULT_BYTES)) == 100
+    assert int(redis.hget(metrics.RESULT_EVICTION_STATS, "expired:count")) == 1
@@ -0,0 +1,184 @@
+import numpy as np
+import pytest
+
+from simulation.raw_reader import LazyRawRead, SweepResult, TracePayload, encode_trace_payload, parse_log_values
+
+
+class Trace:
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=np.float64)
+
+
+def make_container(vgs_values, vds_values):
+    """.dc V1(Vgs) ... V2(Vds) ... と同じ順序（外側がVds）で並べた結果"""
+    vgs = np.tile(vgs_values, len(vds_values))
+    vds = np.repeat(vds_values, len(vgs_values))
+    return {'v(n001)': Trace(vgs), 'v(n002)': Trace(vds), 'id(j1)': Trace(vgs * vds)}
+
+
+def test_nested_sweep_is_reshaped_per_inner_value():
+    vgs_values = np.linspace(-0.4, 0, 5)
+    vds_values = np.linspace(0, 20, 201)
+    sweep = SweepResult(make_container(vgs_values, vds_values), 'v(n001)', ['v(n002)', 'id(j1)'])
+
+    assert sweep.shape == (5, 201)
+    np.testing.assert_allclose(sweep.inner_values, vgs_values)
+    np.testing.assert_allclose(sweep['v(n002)'][2], vds_values)
+    np.testing.assert_allclose(sweep['id(j1)'], np.outer(vgs_values, vds_values))
+
+
+def test_single_point_inner_sweep_gives_one_curve():
+    vds_values = np.linspace(0, 20, 201)
+    sweep = SweepResult(make_container([0.0], vds_values), 'v(n001)', ['v(n002)', 'id(j1)'])
+
+    assert sweep.shape == (1, 201)
+    np.testing.assert_allclose(sweep['v(n002)'][0], vds_values)
+
+
+def test_single_outer_point_gives_one_point_per_curve():
+    vgs_values = np.linspace(-0.4, 0, 5)
+    sweep = SweepResult(make_container(vgs_values, [10.0]), 'v(n001)', ['v(n002)'])
+
+    assert sweep.shape == (5, 1)
+
+
+def build_raw(plotname, flags, variables, columns, dtypes, encoding="latin-1", fastaccess=False):
+    """LTspiceと同じ形式の.rawファイルの内容を作る（columnsは変数ごとの値）"""
+    n_points = len(columns[0])
+    lines = [
+        "Title: * test",
+        "Date: Thu Jan  1 00:00:00 2026",
+        f"Plotname: {plotname}",
+        f"Flags: {flags}{' fastaccess' if fastaccess else ''}",
+        f"No. Variables: {len(variables)}",
+        f"No. Points: {n_points}",
+        "Offset:   0.0000000000000000e+000",
+        "Command: Linear Technology Corporation LTspice XVII",
+        "Variables:",
+    ]
+    lines += [f"\t{i}\t{name}\t{whattype}" for i, (name, whattype) in enumerate(variables)]
+    lines.append("Binary:")
+    header = ("\n".join(lines) + "\n").encode(encoding)
+
+    arrays = [np.asarray(column, dtype=dtype) for column, dtype in zip(columns, dtypes)]
+    if fastaccess:
+        data = b"".join(array.tobytes() for array in arrays)
+    else:
+        record = np.dtype([(f"v{i}", dtype) for i, dtype in enumerate(dtypes)])
+        records = np.empty(n_points, dtype=record)
+        for i, array in enumerate(arrays):
+            records[f"v{i}"] = array
+        data = records.tobytes()
+    return header + data
+
+
+TRAN_VARIABLES = [("time", "time"), ("V(out)", "voltage"), ("I(R1)", "device_current")]
+# 圧縮された点の時刻は負の値で記録される
+TRAN_TIME = [0.0, 1e-9, -2e-9, 3.000000001e-9]
+TRAN_VOUT = [0.0, 0.5, 1.0, 1.5]
+TRAN_IR1 = [0.0, 1e-3, 2e-3, 3e-3]
+TRAN_DTYPES = ["<f8", "<f4", "<f4"]
+
+
+def tran_raw(**kwargs):
+    return build_raw("Transient Analysis", "real forward", TRAN_VARIABLES, [TRAN_TIME, TRAN_VOUT, TRAN_IR1],
+                     TRAN_DTYPES, **kwargs)
+
+
+def assert_tran_traces(raw):
+    assert raw.get_trace_names() == ["time", "V(out)", "I(R1)"]
+    assert raw.get_len() == 4
+    # 横軸はfloat64のまま読み込まれ、圧縮された点の負の時刻は正に戻される
+    np.testing.assert_array_equal(raw["time"].data, np.abs(TRAN_TIME))
+    assert raw["time"].data.dtype == np.float64
+    np.testing.assert_array_equal(raw["v(out)"].data, np.asarray(TRAN_VOUT, dtype=np.float32))
+    np.testing.assert_array_equal(raw["I(R1)"].data, np.asarray(TRAN_IR1, dtype=np.float32))
+    assert raw["I(R1)"].whattype == "device_current"
+
+
+def test_raw_interleaved_float64_axis_with_float32_traces():
+    assert_tran_traces(LazyRawRead(tran_raw()))
+
+
+def test_raw_fastaccess_layout():
+    assert_tran_traces(LazyRawRead(tran_raw(fastaccess=True)))
+
+
+def test_raw_utf16_header():
+    assert_tran_traces(LazyRawRead(tran_raw(encoding="utf-16-le")))
+
+
+def test_raw_from_file(tmp_path):
+    path = tmp_path / "tran.raw"
+    path.write_bytes(tran_raw(encoding="utf-16-le"))
+    assert_tran_traces(LazyRawRead(str(path)))
+
+
+def test_raw_ac_analysis_is_complex():
+    frequency = [1.0, 10.0, 100.0]
+    vout = [1 + 0j, 0.5 - 0.5j, 0.1 - 0.3j]
+    raw = LazyRawRead(build_raw("AC Analysis", "complex forward log", [("frequency", "frequency"), ("V(out)", "voltage")],
+                                [frequency, vout], ["<c16", "<c16"], encoding="utf-16-le"))
+
+    np.testing.assert_array_equal(raw["frequency"].data.real, frequency)
+    np.testing.assert_array_equal(raw["V(out)"].data, vout)
+
+
+def test_raw_operating_point_has_no_axis():
+    variables = [("V(n001)", "voltage"), ("Id(J1)", "device_current")]
+    raw = LazyRawRead(build_raw("Operating Point", "real", variables, [[10.0], [0.0125]], ["<f4", "<f4"],
+                                encoding="utf-16-le"))
+
+    assert raw.get_len() == 1
+    np.testing.assert_array_equal(raw["V(n001)"].data, [10.0])
+    np.testing.assert_array_equal(raw["Id(J1)"].data, np.asarray([0.0125], dtype=np.float32))
+
+
+def test_raw_rejects_ascii_format():
+    raw_text = tran_raw().split(b"Binary:\n")[0] + b"Values:\n0\t0.0\n\t0.0\n\t0.0\n"
+    with pytest.raises(ValueError, match="ASCII"):
+        LazyRawRead(raw_text)
+
+
+def test_raw_rejects_truncated_data():
+    with pytest.raises(ValueError, match="途中で切れています"):
+        LazyRawRead(tran_raw(fastaccess=True)[:-4])
+
+
+def test_raw_rejects_truncated_header():
+    with pytest.raises(ValueError, match="ヘッダが見つかりません"):
+        LazyRawRead(tran_raw(encoding="utf-16-le")[:100])
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_trace_payload_round_trip(dtype):
+    raw = LazyRawRead(tran_raw(encoding="utf-16-le"))
+    op_values = parse_log_values("Semiconductor Device Operating Points:\nId:         1.34e-02\nGm:   3.83e-02\n")
+    payload = TracePayload(encode_trace_payload(raw, ["time", "I(R1)"], dtype, op_values))
+
+    assert payload.get_trace_names() == ["time", "I(R1)"]
+    assert payload.get_len() == 4
+    assert payload.raw_params["Plotname"] == "Transient Analysis"
+    assert payload.op_values == {"id": 1.34e-02, "gm": 3.83e-02}
+    for name in ("time", "I(R1)"):
+        assert payload[name]._view.dtype == np.dtype(dtype).newbyteorder("<")
+        assert payload[name].data.shape == raw[name].data.shape
+        np.testing.assert_array_equal(payload[name].data, raw[name].data.astype(dtype))
+    assert payload["I(R1)"].whattype == "device_current"
+    with pytest.raises(KeyError):
+        payload["V(out)"]
+
+
+def test_trace_payload_round_trip_complex():
+    raw = LazyRawRead(build_raw("AC Analysis", "complex forward log", [("frequency", "frequency"), ("V(out)", "voltage")],
+                                [[1.0, 10.0], [1 + 0j, 0.5 - 0.5j]], ["<c16", "<c16"]))
+    payload = TracePayload(encode_trace_payload(raw, ["V(out)"], "float32"))
+
+    assert payload["V(out)"]._view.dtype == np.dtype("<c8")
+    np.testing.assert_array_equal(payload["V(out)"].data, [1 + 0j, 0.5 - 0.5j])
+    assert payload.op_values == {}
+
+
+def test_trace_payload_rejects_other_data():
+    with pytest.raises(ValueError):
+        TracePayload(b"PK\x03\x04" + b"\0" * 16)
@@ -0,0 +1,93 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+
+pytest.importorskip("lupa")  # fakeredisでLuaのスクリプトを実行するために必要
+pytest.importorskip("celery")
+pytest.importorskip("PyLTSpice")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "simulation"))
+
+import redis_worker  # noqa: E402
+from simulation.job_model import JobModel, ATTACH_INFLIGHT_SCRIPT  # noqa: E402
+
+
+class RecordingCelery:
+    def __init__(self):
+        self.sent = []
+
+    def send_task(self, name, kwargs):
+        self.sent.append((name, kwargs))
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    redis = fakeredis.FakeRedis()
+    monkeypatch.setattr(redis_worker, "redis", redis)
+    monkeypatch.setattr(redis_worker, "FINISH_INFLIGHT_SCRIPT",
+                        redis.register_script(redis_worker.FINISH_INFLIGHT_SCRIPT.script))
+    monkeypatch.setattr(redis_worker, "celery", RecordingCelery())
+    return redis
+
+
+@pytest.fixture
+def job_model(fake_redis):
+    model = JobModel()
+    model.redis = fake_redis
+    model.attach_inflight = fake_redis.register_script(ATTACH_INFLIGHT_SCRIPT)
+    return model
+
+
+def submit(job_model, on_complete=None):
+    return job_model.create_job_from_data("job.net", b"* netlist\n", priority="batch", on_complete=on_complete)
+
+
+def test_follower_completes_with_primary(job_model, fake_redis):
+    primary_id = submit(job_model)
+    follower_id = submit(job_model, on_complete={"task": "tasks.process_result", "kwargs": {}})
+
+    result_key = f"{redis_worker.REDIS_RESULT_PREFIX}{primary_id}"
+    redis_worker.update_job(primary_id, status="completed", result_key=result_key)
+    redis_worker.finish_job(primary_id, "completed")
+
+    follower = job_model.get_job_meta(follower_id)
+    assert follower["status"] == "completed"
+    assert follower["result_key"] == result_key
+    assert job_model.wait_for_job(follower_id, timeout=1) == "completed"
+    assert redis_worker.celery.sent == [
+        ("tasks.process_result", {"job_id": follower_id, "status": "completed"}),
+    ]
+    assert not fake_redis.exists(f"{redis_worker.REDIS_JOB_PREFIX}{primary_id}:followers")
+    # どちらも終了したジョブとして削除の対象になり、結果は両方から参照される
+    assert fake_redis.zrange(redis_worker.FINISHED_JOBS, 0, -1) == sorted([primary_id.encode(), follower_id.encode()])
+    assert int(fake_redis.hget(redis_worker.RESULT_REFS, result_key)) == 2
+
+
+def test_follower_fails_with_primary(job_model):
+    primary_id = submit(job_model)
+    follower_id = submit(job_model)
+
+    redis_worker.update_job(primary_id, status="failed", error="simulation error")
+    redis_worker.finish_job(primary_id, "failed")
+
+    follower = job_model.get_job_meta(follower_id)
+    assert follower["status"] == "failed"
+    assert follower["error"] == "simulation error"
+    assert job_model.wait_for_job(follower_id, timeout=1) == "failed"
+
+
+def test_follower_completes_when_primary_finishes_right_after_attach(job_model):
+    primary_id = submit(job_model)
+    primary = job_model.get_job_meta(primary_id)
+
+    # 相乗りの登録（スクリプト）の直後、submit_jobの残りの処理より先に実行元が完了した場合
+    follower_id = "follower"
+    job_data = {key: primary[key] for key in ("status", "error", "file_path", "result_format", "cache_key")}
+    assert job_model.register_inflight(follower_id, job_data, "batch")
+    redis_worker.update_job(primary_id, status="completed", result_key=f"{redis_worker.REDIS_RESULT_PREFIX}{primary_id}")
+    redis_worker.finish_job(primary_id, "completed")
+
+    assert job_model.get_job_meta(follower_id)["status"] == "completed"
+    assert job_model.wait_for_job(follower_id, timeout=1) == "completed"